@@ -0,0 +1,61 @@
+import random
+from datetime import datetime, timedelta
+from benchmarks.harness import bench
+from services.exporter import export_leaderboard_html, export_leaderboard_xlsx, generate_leaderboard_html
+
+NUM_QUESTIONS = 50
+REGIONS = ["Toshkent", "Samarqand", "Buxoro", "Andijon", None]
+# XLSX takes about a second per thousand rows; bigger sizes only run the HTML export
+XLSX_MAX_ROWS = 10000
+
+
+def make_rows(n, seed=2):
+    """Leaderboard rows shaped like iter_test_submissions(with_answers=True)."""
+    rng = random.Random(seed)
+    submitted = datetime(2024, 1, 1, 9)
+    rows = []
+    for i in range(n):
+        correct = rng.randint(0, NUM_QUESTIONS)
+        rows.append({
+            'id': i + 1,
+            'user_id': i + 1,
+            'full_name': f"Ishtirokchi {i}",
+            'username': f"user{i}" if i % 3 else None,
+            'region': rng.choice(REGIONS),
+            'correct_count': correct,
+            'wrong_count': NUM_QUESTIONS - correct,
+            'percent': round(correct / NUM_QUESTIONS * 100.0, 2),
+            'time_taken_seconds': rng.randint(60, 7200),
+            'submitted_at': submitted + timedelta(seconds=i),
+            'normalized_answers': "".join(rng.choice("ABCD") for _ in range(NUM_QUESTIONS)),
+        })
+    rows.sort(key=lambda r: (-r['percent'], -r['correct_count'], r['time_taken_seconds']))
+    return rows
+
+
+def _close(result):
+    fp, _ = result
+    fp.close()
+
+
+def collect(sizes):
+    benchmarks = []
+    for n in sizes:
+        rows = make_rows(n)
+        by_region = sorted(rows, key=lambda r: r['region'] or "")
+        # Large exports are slow enough that a few repeats give a stable number
+        repeat = 5 if n <= 10000 else 2
+        benchmarks += [
+            bench(f"exporter.html_{n}", lambda rows=rows: _close(export_leaderboard_html("Bench", rows)), repeat=repeat),
+            bench(f"exporter.generate_leaderboard_html_{n}", lambda rows=rows: generate_leaderboard_html("Bench", rows), repeat=repeat),
+        ]
+        if n <= XLSX_MAX_ROWS:
+            benchmarks.append(bench(
+                f"exporter.xlsx_{n}",
+                lambda rows=rows, by_region=by_region: _close(
+                    export_leaderboard_xlsx("Bench", rows, by_region, NUM_QUESTIONS, "A" * NUM_QUESTIONS)
+                ),
+                repeat=3 if n < XLSX_MAX_ROWS else 1,
+                warmup=n < XLSX_MAX_ROWS,
+            ))
+    return benchmarks
@@ -0,0 +1,41 @@
+import random
+from benchmarks.harness import bench
+from services.grader import (
+    normalize_answers, grade_submission, grade_batch, grade_with_plan, compile_plan
+)
+from services.analytics import analyze_submissions
+
+NUM_QUESTIONS = 300
+BATCH_SIZE = 1000
+
+
+def collect(sizes):
+    rng = random.Random(1)
+    key = "".join(rng.choice("ABCD") for _ in range(NUM_QUESTIONS))
+    letters = "".join(rng.choice("abcd") for _ in range(NUM_QUESTIONS))
+    indexed = " ".join(f"{i}{c}" for i, c in enumerate(letters, 1))
+    submission = normalize_answers(letters)
+    batch = ["".join(rng.choice("ABCD") for _ in range(NUM_QUESTIONS)) for _ in range(BATCH_SIZE)]
+    spec = "!0.25 " + " ".join(
+        c + rng.choice(("", "/B")) + rng.choice(("", "*2")) for c in key
+    )
+    plan = compile_plan("", spec)
+
+    benchmarks = [
+        bench("grader.normalize_letters_300", lambda: normalize_answers(letters), number=1000),
+        bench("grader.normalize_indexed_300", lambda: normalize_answers(indexed), number=1000),
+        bench("grader.grade_submission_300", lambda: grade_submission(submission, key), number=1000),
+        bench("grader.grade_with_plan_300", lambda: grade_with_plan(submission, plan.key, plan), number=1000),
+        # Skip the lru_cache: this is the cost of a key change
+        bench("grader.compile_plan_300", lambda: compile_plan.__wrapped__("", spec), number=20),
+        bench(f"grader.grade_batch_300x{BATCH_SIZE}", lambda: grade_batch(key, batch), number=10),
+        bench(f"grader.grade_batch_plan_300x{BATCH_SIZE}", lambda: grade_batch(plan.key, batch, plan=plan), number=10),
+    ]
+    for n in sizes:
+        answers = [rng.choice(batch) for _ in range(n)]
+        benchmarks.append(bench(
+            f"analytics.analyze_submissions_300x{n}",
+            lambda answers=answers: analyze_submissions(key, answers, len(answers)),
+            repeat=3,
+        ))
+    return benchmarks
@@ -0,0 +1,135 @@
+import itertools
+import random
+from datetime import datetime, timedelta
+from benchmarks.harness import bench
+from db.init_db import init_db
+import db.queries as q
+
+NUM_QUESTIONS = 50
+# Users and submissions in the seeded test
+SEED_ROWS = 10000
+
+
+def seed(rows=SEED_ROWS):
+    """Fills a fresh SQLite database: `rows` users, one active test they all answered."""
+    init_db()
+    rng = random.Random(3)
+    key = "".join(rng.choice("ABCD") for _ in range(NUM_QUESTIONS))
+    test_id = q.create_test("Bench", NUM_QUESTIONS, 3)
+    q.update_test_answer_key(test_id, key)
+    now = datetime.now()
+    q.start_test_db(test_id, now, now + timedelta(hours=3))
+
+    def insert():
+        with q.get_connection() as conn:
+            c = conn.cursor()
+            c.executemany(
+                "INSERT INTO users (tg_user_id, username, full_name, region) VALUES (?, ?, ?, ?)",
+                [(1000000 + i, f"user{i}", f"Ishtirokchi {i}", "Toshkent") for i in range(rows)]
+            )
+            submissions = []
+            for user_id in range(1, rows + 1):
+                answers = "".join(rng.choice("ABCD") for _ in range(NUM_QUESTIONS))
+                correct = sum(a == k for a, k in zip(answers, key))
+                submissions.append((
+                    test_id, user_id, answers, answers, correct, NUM_QUESTIONS - correct,
+                    round(correct / NUM_QUESTIONS * 100.0, 2), now, rng.randint(60, 7200)
+                ))
+            c.executemany('''
+                INSERT INTO submissions
+                (test_id, user_id, raw_answers, normalized_answers, correct_count, wrong_count, percent, started_at, time_taken_seconds)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', submissions)
+            conn.commit()
+
+    # The bulk seed is a write too, so it goes through the writer thread
+    q.get_pool().run_write(insert)
+    return test_id, key
+
+
+def collect(rows=SEED_ROWS):
+    test_id, key = seed(rows)
+    answers = "A" * NUM_QUESTIONS
+    tg_ids = itertools.count(2000000)
+    now = datetime.now()
+
+    # Write benchmarks insert into a fresh test each repeat, so UNIQUE(test_id, user_id)
+    # never trips: each call takes the next seeded user
+    state = {}
+
+    def new_test():
+        state['test_id'] = q.create_test("Bench write", NUM_QUESTIONS, 3)
+        state['user_ids'] = itertools.count(1)
+    new_test()
+
+    def insert_one():
+        q.insert_submission(state['test_id'], next(state['user_ids']), answers, answers, 10, 40, 20.0, now, 100)
+
+    def create_one():
+        q.create_submission(state['test_id'], next(state['user_ids']), answers, answers, 10, 40, 20.0, now, 100)
+
+    def insert_batch():
+        q.insert_submissions_batch([
+            (state['test_id'], user_id, answers, answers, 10, 40, 20.0, now, 100) for user_id in range(1, 201)
+        ])
+
+    def consume(rows):
+        for _ in rows:
+            pass
+
+    broadcast_id = q.create_broadcast(1, 1, 1, None, rows)
+
+    # Stored bot state: 200 users' user_data and open registrations
+    state_batch = (
+        {user_id: '{"reg_name": "Ishtirokchi"}' for user_id in range(1000000, 1000200)},
+        {("registration", f"[{user_id}, {user_id}]"): "1" for user_id in range(1000000, 1000200)},
+    )
+    q.save_persistence(*state_batch)
+
+    return [
+        # Users
+        bench("queries.upsert_user_insert", lambda: q.upsert_user(next(tg_ids), "u", "Yangi"), number=200),
+        bench("queries.upsert_user_update", lambda: q.upsert_user(1000000, "user0", "Ishtirokchi 0"), number=200),
+        bench("queries.get_user_by_tg_id", lambda: q.get_user_by_tg_id(1000500), number=500),
+        bench("queries.get_registered_user_cached", lambda: q.get_registered_user(1000500), number=2000),
+        bench("queries.load_registered_user", lambda: q.load_registered_user(1000500), number=500),
+        bench(f"queries.get_all_users_{rows}", q.get_all_users),
+        bench("queries.get_user_count", q.get_user_count, number=20),
+        # Tests
+        bench("queries.create_test", lambda: q.create_test("Yangi", NUM_QUESTIONS, 1), number=200),
+        bench("queries.get_test", lambda: q.get_test(test_id), number=500),
+        bench("queries.get_test_meta_cached", lambda: q.get_test_meta(test_id), number=2000),
+        bench("queries.load_test_meta", lambda: q.load_test_meta(test_id), number=500),
+        bench("queries.update_test_answer_key", lambda: q.update_test_answer_key(state['test_id'], key), number=200),
+        bench("queries.start_test_db", lambda: q.start_test_db(state['test_id'], now, now + timedelta(hours=1)), number=200),
+        bench("queries.end_test_db", lambda: q.end_test_db(state['test_id']), number=200),
+        bench("queries.get_active_tests_needing_end", lambda: q.get_active_tests_needing_end(now), number=200),
+        bench("queries.get_active_tests", q.get_active_tests, number=200),
+        bench("queries.get_all_tests", q.get_all_tests, number=200),
+        bench("queries.get_scheduled_tests", q.get_scheduled_tests, number=200),
+        # Submissions
+        bench("queries.insert_submission", insert_one, number=200, setup=new_test),
+        bench("queries.create_submission", create_one, number=200, setup=new_test),
+        bench("queries.insert_submissions_batch_200", insert_batch, setup=new_test),
+        bench("queries.get_submission", lambda: q.get_submission(test_id, 500), number=500),
+        bench(f"queries.get_test_submissions_{rows}", lambda: q.get_test_submissions(test_id), repeat=3),
+        bench(f"queries.regrade_submissions_{rows}", lambda: q.regrade_submissions(test_id), repeat=3),
+        bench(f"queries.iter_test_submissions_{rows}", lambda: consume(q.iter_test_submissions(test_id)), repeat=3),
+        bench(f"queries.iter_test_submissions_answers_{rows}",
+              lambda: consume(q.iter_test_submissions(test_id, with_answers=True)), repeat=3),
+        bench("queries.get_top_submissions", lambda: q.get_top_submissions(test_id), number=20),
+        bench("queries.get_submission_count", lambda: q.get_submission_count(test_id), number=200),
+        # Broadcasts
+        bench("queries.create_broadcast", lambda: q.create_broadcast(1, 1, 1, None, rows), number=200),
+        bench("queries.get_broadcast", lambda: q.get_broadcast(broadcast_id), number=500),
+        bench("queries.get_running_broadcasts", q.get_running_broadcasts, number=20),
+        bench("queries.get_broadcast_recipients_100",
+              lambda: q.get_broadcast_recipients(rows // 2, 100), number=200),
+        bench("queries.update_broadcast_progress",
+              lambda: q.update_broadcast_progress(broadcast_id, 100, 100, 0), number=200),
+        bench("queries.finish_broadcast", lambda: q.finish_broadcast(broadcast_id, now), number=200),
+        # Bot persistence
+        bench("queries.load_user_data", lambda: q.load_user_data(1000100), number=500),
+        bench("queries.load_conversations_200", lambda: q.load_conversations("registration"), number=200),
+        bench("queries.save_persistence_200", lambda: q.save_persistence(*state_batch), number=20),
+    ]
@@ -0,0 +1,107 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from collections import namedtuple
+from datetime import datetime
+
+# fn is timed `number` times in a row, `repeat` times; setup (if any) runs
+# untimed before each repeat. warmup adds one untimed call first.
+Benchmark = namedtuple("Benchmark", ["name", "fn", "repeat", "number", "setup", "warmup"])
+
+def bench(name, fn, repeat=5, number=1, setup=None, warmup=True):
+    return Benchmark(name, fn, repeat, number, setup, warmup)
+
+
+def run_benchmark(b):
+    """Times one benchmark. Returns seconds per call: min, median and mean over the repeats."""
+    if b.warmup:
+        # One untimed call warms caches and imports
+        if b.setup:
+            b.setup()
+        b.fn()
+    timings = []
+    for _ in range(b.repeat):
+        if b.setup:
+            b.setup()
+        start = time.perf_counter()
+        for _ in range(b.number):
+            b.fn()
+        timings.append((time.perf_counter() - start) / b.number)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'repeat': b.repeat,
+        'number': b.number,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_all(benchmarks, log=print):
+    results = {}
+    for b in benchmarks:
+        results[b.name] = run_benchmark(b)
+        log(f"{b.name:<48} {format_seconds(results[b.name]['min']):>10}")
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+
+def format_seconds(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def save(report, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=0.2, stat='min', log=print):
+    """
+    Prints current vs baseline for every benchmark in both reports and
+    returns the names of those more than `threshold` slower (0.2 = 20%).
+    """
+    regressions = []
+    base_results = baseline['results']
+    for name, result in current['results'].items():
+        if name not in base_results:
+            log(f"{name:<48} {'new':>10}")
+            continue
+        before = base_results[name][stat]
+        after = result[stat]
+        ratio = after / before if before else float('inf')
+        if ratio > 1 + threshold:
+            verdict = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            verdict = "faster"
+        else:
+            verdict = ""
+        log(f"{name:<48} {format_seconds(before):>10} -> {format_seconds(after):>10} {ratio:6.2f}x {verdict}")
+    return regressions
@@ -0,0 +1,387 @@
+"""
+End-to-end load test: the real handlers, wired exactly as in main.py, fed
+synthetic updates through a fake Telegram transport (no network).
+
+Each virtual user sends /start, their name, their region and a
+TestID*Answers submission, waiting for each reply like a real client.
+Users run `--concurrency` at a time; all of them share a `--rate`
+updates/second budget. Updates go straight onto the update queue, or with
+--webhook are POSTed to the bot's own webhook server on localhost, the way
+Telegram delivers them.
+
+    python -m benchmarks.loadtest --users 2000 --concurrency 200 --rate 500
+    python -m benchmarks.loadtest --api-latency 0.1 --output load.json
+    python -m benchmarks.loadtest --webhook
+
+Reported: per-handler p50/p95/p99 (handler time, and end to end including
+time queued behind other updates), throughput, database executor time and
+event-loop lag. Runs on a throwaway SQLite database unless --database-url
+is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from telegram.request import BaseRequest
+
+REGIONS = ["Toshkent shahri", "Samarqand", "Buxoro", "O'tkazib yuborish"]
+# How often the lag monitor wakes up
+LAG_INTERVAL = 0.01
+# An update that gets no reply in this long counts as lost
+UPDATE_TIMEOUT = 60
+
+
+class FakeRequest(BaseRequest):
+    """
+    Stands in for the HTTP layer under a real telegram.Bot: every API call
+    sleeps `latency` seconds and returns a plausible result.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = iter(range(1, sys.maxsize))
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        payload = {"ok": True, "result": self._result(endpoint, params)}
+        return 200, json.dumps(payload).encode()
+
+    def _message(self, params):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id", 0), "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    def _result(self, endpoint, params):
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        if endpoint == "getChatMember":
+            return {"status": "member", "user": {"id": params["user_id"], "is_bot": False, "first_name": "U"}}
+        if endpoint == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if endpoint == "sendDocument":
+            message = self._message(params)
+            message["document"] = {"file_id": f"doc{message['message_id']}", "file_unique_id": f"u{message['message_id']}"}
+            return message
+        if endpoint in ("sendMessage", "editMessageText"):
+            return self._message(params)
+        return True
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values, default=0.0),
+    }
+
+
+class Recorder:
+    """Collects per-handler timings and wakes the user waiting on each update."""
+
+    def __init__(self):
+        self.handler_times = defaultdict(list)
+        self.end_to_end = defaultdict(list)
+        self._pending = {}  # update_id -> (enqueued_at, asyncio.Event)
+
+    def expect(self, update_id):
+        event = asyncio.Event()
+        self._pending[update_id] = (time.perf_counter(), event)
+        return event
+
+    def handled(self, update, name, seconds):
+        self.handler_times[name].append(seconds)
+        pending = self._pending.pop(getattr(update, 'update_id', None), None)
+        if pending is not None:
+            enqueued_at, event = pending
+            self.end_to_end[name].append(time.perf_counter() - enqueued_at)
+            event.set()
+
+
+def instrument(application, recorder):
+    """Wraps every handler callback, including those inside conversations, with a timer."""
+    from telegram.ext import ConversationHandler
+
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks:
+                wrap(inner)
+            for handlers in handler.states.values():
+                for inner in handlers:
+                    wrap(inner)
+            return
+        callback = handler.callback
+        if getattr(callback, '_timed', False):
+            return
+        name = callback.__name__
+
+        async def timed(update, context):
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                recorder.handled(update, name, time.perf_counter() - start)
+        timed._timed = True
+        handler.callback = timed
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+
+async def monitor_lag(samples, stop):
+    """Records how late the loop wakes a sleeping task: a blocked loop shows up here."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def post_update(port, path, secret, payload):
+    """Delivers one update to the webhook server like Telegram does. Returns the HTTP status."""
+    body = json.dumps(payload).encode()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"POST /{path} HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{port}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+        "Connection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    await writer.wait_closed()
+    return int(status_line.split()[1])
+
+
+def make_update(update_id, user_id, text):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": "Load"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+async def run(args):
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder
+    import main as bot_main
+    import db.async_queries as db
+    from services.broadcast import RateLimiter
+    from services.update_processor import update_processor
+    from services.persistence import persistence
+    from services import metrics
+
+    rng = random.Random(args.seed)
+    transport = FakeRequest(args.api_latency)
+    application = (
+        ApplicationBuilder()
+        .token("123456:LOADTEST")
+        .request(metrics.TimedRequest(transport) if metrics.ENABLED else transport)
+        .get_updates_request(FakeRequest())
+        .job_queue(None)
+        .concurrent_updates(update_processor)
+        .persistence(persistence)
+        .build()
+    )
+    bot_main.register_handlers(application)
+    metrics.instrument_handlers(application)
+    recorder = Recorder()
+    instrument(application, recorder)
+
+    test_id = await db.create_test("Load test", args.questions, 3)
+    await db.update_test_answer_key(test_id, "".join(rng.choice("ABCD") for _ in range(args.questions)))
+    await db.start_test_db(test_id, datetime.now(), datetime.now() + timedelta(hours=3))
+
+    await application.initialize()
+    await bot_main.on_startup(application)
+    await application.start()
+    webhook = None
+    if args.webhook:
+        port, path, secret = free_port(), "telegram", secrets.token_urlsafe(16)
+        await application.updater.start_webhook(**bot_main.webhook_options(
+            listen="127.0.0.1", port=port, url_path=path,
+            webhook_url=f"https://loadtest.invalid/{path}", secret_token=secret,
+        ))
+        # A request without the right secret must be turned away
+        webhook = {'bad_secret_status': await post_update(port, path, "wrong", make_update(0, 1, "/start"))}
+
+    limiter = RateLimiter(args.rate)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    update_ids = iter(range(1, sys.maxsize))
+    lost = Counter()
+
+    async def send(user_id, text, step):
+        await limiter.acquire()
+        update_id = next(update_ids)
+        event = recorder.expect(update_id)
+        if args.webhook:
+            if await post_update(port, path, secret, make_update(update_id, user_id, text)) != 200:
+                lost[step] += 1
+                return
+        else:
+            await application.update_queue.put(Update.de_json(make_update(update_id, user_id, text), application.bot))
+        try:
+            await asyncio.wait_for(event.wait(), UPDATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            lost[step] += 1
+
+    async def user_session(user_id):
+        answers = "".join(rng.choice("abcd") for _ in range(args.questions))
+        async with semaphore:
+            await send(user_id, "/start", "start")
+            await send(user_id, f"Load User {user_id}", "name")
+            await send(user_id, rng.choice(REGIONS), "region")
+            await send(user_id, f"{test_id}*{answers}", "submission")
+
+    lag_samples = []
+    stop_lag = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_lag(lag_samples, stop_lag))
+    db_before = db.db_stats()
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(args.first_user_id + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    db_after = db.db_stats()
+    stop_lag.set()
+    await lag_task
+
+    stored = await db.get_submission_count(test_id)
+    if args.webhook:
+        await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot_main.on_shutdown(application)
+
+    handled = sum(len(v) for v in recorder.end_to_end.values())
+    return {
+        'config': vars(args),
+        'elapsed_seconds': elapsed,
+        'updates': handled,
+        'throughput_per_second': handled / elapsed if elapsed else 0.0,
+        'lost_updates': dict(lost),
+        'submissions_stored': stored,
+        'handlers': {
+            name: {'handler': summarize(times), 'end_to_end': summarize(recorder.end_to_end[name])}
+            for name, times in sorted(recorder.handler_times.items())
+        },
+        'db': {key: db_after[key] - db_before[key] for key in db_after},
+        'event_loop_lag': summarize(lag_samples),
+        'update_processor': update_processor.stats(),
+        'api_calls': dict(transport.calls),
+        'webhook': webhook,
+    }
+
+
+def print_report(report):
+    from benchmarks.harness import format_seconds as fmt
+    print(f"\n{report['updates']} updates in {report['elapsed_seconds']:.2f}s "
+          f"({report['throughput_per_second']:.1f}/s), "
+          f"{report['submissions_stored']} submissions stored")
+    if report['lost_updates']:
+        print(f"Updates without a reply: {report['lost_updates']}")
+    print(f"\n{'handler':<28}{'count':>7}  {'p50':>9}{'p95':>9}{'p99':>9}  |  end to end {'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in report['handlers'].items():
+        h, e = stats['handler'], stats['end_to_end']
+        print(f"{name:<28}{h['count']:>7}  {fmt(h['p50']):>9}{fmt(h['p95']):>9}{fmt(h['p99']):>9}  |"
+              f"             {fmt(e['p50']):>9}{fmt(e['p95']):>9}{fmt(e['p99']):>9}")
+    db = report['db']
+    per_call = db['busy_seconds'] / db['calls'] if db['calls'] else 0.0
+    print(f"\nDB: {db['calls']} calls, {db['busy_seconds']:.2f}s running ({fmt(per_call)}/call), "
+          f"{db['wait_seconds']:.2f}s waiting for a worker")
+    updates = report['update_processor']
+    print(f"Updates: {updates['limit']} at a time, peak queue {updates['peak_queued']}, "
+          f"chat wait p95 {fmt(updates['chat_wait_p95'])}, slot wait p95 {fmt(updates['slot_wait_p95'])}")
+    lag = report['event_loop_lag']
+    print(f"Event loop lag: p50 {fmt(lag['p50'])}, p99 {fmt(lag['p99'])}, max {fmt(lag['max'])}")
+    print(f"Telegram API calls: {report['api_calls']}")
+    if report['webhook']:
+        print(f"Webhook: request with a wrong secret got HTTP {report['webhook']['bad_secret_status']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the bot's handlers with synthetic load.")
+    parser.add_argument("--users", type=int, default=1000, help="virtual users, 4 updates each")
+    parser.add_argument("--concurrency", type=int, default=100, help="users active at the same time")
+    parser.add_argument("--rate", type=float, default=500, help="max updates per second, across all users")
+    parser.add_argument("--questions", type=int, default=50, help="questions in the test being submitted")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="seconds each fake Telegram call takes")
+    parser.add_argument("--update-concurrency", type=int, help="updates handled at once (default: UPDATE_CONCURRENCY)")
+    parser.add_argument("--metrics", action="store_true", help="turn on services.metrics to measure its overhead")
+    parser.add_argument("--webhook", action="store_true", help="deliver updates over HTTP to the webhook server")
+    parser.add_argument("--database-url", help="PostgreSQL URL; default is a throwaway SQLite file")
+    parser.add_argument("--first-user-id", type=int, default=10 ** 9, help="Telegram id of the first virtual user")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the report as JSON here")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="bluebot-load-")
+    # Must happen before config is imported
+    os.environ["DB_PATH"] = os.path.join(workdir, "load.db")
+    os.environ["DATABASE_URL"] = args.database_url or ""
+    if args.metrics:
+        os.environ["METRICS_ENABLED"] = "1"
+    if args.update_concurrency:
+        os.environ["UPDATE_CONCURRENCY"] = str(args.update_concurrency)
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['lost_updates'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
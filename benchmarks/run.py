@@ -0,0 +1,64 @@
+"""
+Offline benchmarks for the grader, the exporters and the query layer.
+
+    python -m benchmarks.run                      # run everything, write benchmarks/results/latest.json
+    python -m benchmarks.run --filter grader      # only names containing "grader"
+    python -m benchmarks.run --sizes 1000,10000   # export/analysis sizes (default 1k, 10k, 100k)
+    python -m benchmarks.run --compare benchmarks/results/baseline.json --threshold 0.2
+
+Queries run against a throwaway SQLite database, whatever the .env says.
+With --compare, the exit status is 1 when any benchmark got more than
+--threshold slower than in the baseline (compared on the best repeat).
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+# Git-ignored, so results don't end up committed by accident
+DEFAULT_OUTPUT = os.path.join("benchmarks", "results", "latest.json")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the JSON results")
+    parser.add_argument("--compare", metavar="BASELINE", help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as a regression (0.2 = 20%%)")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="row counts for export benchmarks")
+    parser.add_argument("--rows", type=int, default=10000, help="users and submissions seeded for query benchmarks")
+    args = parser.parse_args(argv)
+    sizes = [int(n) for n in args.sizes.split(",") if n]
+
+    workdir = tempfile.mkdtemp(prefix="bluebot-bench-")
+    # Must happen before config is imported
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["DATABASE_URL"] = ""
+
+    from benchmarks import harness, bench_grader, bench_exporter, bench_queries
+    from db.queries import close_pool
+
+    benchmarks = bench_grader.collect(sizes) + bench_exporter.collect(sizes) + bench_queries.collect(args.rows)
+    benchmarks = [b for b in benchmarks if args.filter in b.name]
+
+    try:
+        report = harness.run_all(benchmarks)
+    finally:
+        close_pool()
+        shutil.rmtree(workdir, ignore_errors=True)
+    harness.save(report, args.output)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        print(f"\nCompared with {args.compare}:")
+        regressions = harness.compare(harness.load(args.compare), report, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
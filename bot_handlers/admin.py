@@ -1,12 +1,19 @@
 import logging
+from html import escape
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-from bot_handlers.common import is_admin, ASK_TITLE, ASK_QUESTIONS, ASK_DURATION, ASK_CONFIRM, ASK_ANSWER_KEY, ASK_BROADCAST_MSG
-import db.queries as db
-from services.grader import normalize_answers
-from services.exporter import generate_leaderboard_html
+from bot_handlers.common import is_admin, subscription_cache_stats, ASK_TITLE, ASK_QUESTIONS, ASK_DURATION, ASK_CONFIRM, ASK_ANSWER_KEY, ASK_BROADCAST_MSG
+import db.async_queries as db
+from db.writer import submission_writer
+from services.grader import normalize_answers, is_plan_text, parse_plan, format_plan, compile_plan
+from services.leaderboard import send_leaderboard, FORMATS
+from services.ranking import get_index, load_index, drop_index
+from services.analytics import compute_item_analysis, item_rows
+from services.broadcast import start_campaign
+from services.update_processor import update_processor
+from services import metrics
+from scheduler.jobs import schedule_test_end, cancel_test_jobs
 from datetime import datetime, timedelta
-from io import BytesIO
 import config
 
 logger = logging.getLogger(__name__)
@@ -54,16 +61,49 @@ async def admin_home_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         parse_mode='HTML'
     )
 
+def _format_bound(seconds):
+    # Histogram quantiles are bucket upper bounds
+    if seconds == float('inf'):
+        return f">{metrics.BUCKETS[-1]:g} s"
+    return f"≤{seconds * 1000:g} ms" if seconds < 1 else f"≤{seconds:g} s"
+
+def metrics_summary():
+    """Slowest handlers, queries and API methods by p95, for the stats view."""
+    if not metrics.ENABLED:
+        return ""
+    lines = ["\n\n<b>Eng sekin (p95):</b>"]
+    for title, histogram in (("Handlerlar", metrics.handler_seconds),
+                             ("So'rovlar", metrics.query_seconds),
+                             ("Telegram API", metrics.api_seconds)):
+        rows = metrics.slowest(histogram)
+        if rows:
+            lines.append(f"<i>{title}:</i> " + ", ".join(
+                f"{escape(name)} {_format_bound(p95)} ({count})" for name, count, p95 in rows
+            ))
+    lines.append(
+        f"Xatolar: handler {metrics.handler_errors.total()}, so'rov {metrics.query_errors.total()}, "
+        f"job {metrics.job_errors.total()}; Telegram 429: {metrics.api_rate_limited.total()}"
+    )
+    return "\n".join(lines)
+
 async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    count = db.get_user_count()
+    count = await db.get_user_count()
+    sub = subscription_cache_stats()
+    updates = update_processor.stats()
     
     keyboard = [[InlineKeyboardButton("⬅️ Orqaga", callback_data="admin_home")]]
     await query.edit_message_text(
         f"📈 <b>Statistika</b>\n\n"
-        f"👤 Jami foydalanuvchilar: <b>{count}</b> ta",
+        f"👤 Jami foydalanuvchilar: <b>{count}</b> ta\n\n"
+        f"<b>Obuna keshi:</b> {sub['hit_rate']:.0%} "
+        f"(hit {sub['hits']}, miss {sub['misses']}, birlashtirilgan {sub['coalesced']}, xato {sub['errors']})\n"
+        f"<b>Yangilanishlar:</b> ishlanmoqda {updates['running']}/{updates['limit']}, "
+        f"navbatda {updates['queued']} (eng ko'p {updates['peak_queued']}), "
+        f"chat kutishi p95 {updates['chat_wait_p95'] * 1000:.0f} ms"
+        + metrics_summary(),
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='HTML'
     )
@@ -154,7 +194,7 @@ async def confirm_creation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     n = context.user_data['num_questions']
     h = context.user_data['duration_hours']
     
-    test_id = db.create_test(title, n, h)
+    test_id = await db.create_test(title, n, h)
     
     msg = f"Test yaratildi! ID = <b>{test_id}</b>"
     
@@ -174,7 +214,7 @@ async def set_key_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     test_id = int(query.data.split("_")[-1])
-    test = db.get_test(test_id)
+    test = await db.get_test(test_id)
     if not test:
         await query.edit_message_text("Test topilmadi.")
         return ConversationHandler.END
@@ -184,43 +224,98 @@ async def set_key_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await query.message.reply_text(
         f"Test <b>{test_id}</b> uchun javoblarni yuboring ({test['num_questions']} ta).\n"
-        "Format: 'ABCD...' yoki '1A 2B...'", 
+        "Format: 'ABCD...' yoki '1A 2B...'\n\n"
+        "Baholash rejasi (har savol uchun bitta belgi, bo'sh joy bilan):\n"
+        "<code>A</code> - 1 ball, <code>B/C</code> - B yoki C to'g'ri, "
+        "<code>D*2</code> - 2 ball, <code>A!0.5</code> - xato uchun -0.5 ball.\n"
+        "Boshida <code>!0.25</code> - barcha savollar uchun jarima.", 
         parse_mode='HTML'
     )
     return ASK_ANSWER_KEY
 
 async def receive_answer_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     raw_key = update.message.text
-    normalized = normalize_answers(raw_key)
     target_n = context.user_data['key_num_questions']
+    spec = None
+    
+    if is_plan_text(raw_key):
+        try:
+            questions = parse_plan(raw_key)
+        except ValueError as e:
+            await update.message.reply_text(
+                f"❌ Noto'g'ri belgi: {e}\nQaytadan yuboring yoki /cancel."
+            )
+            return ASK_ANSWER_KEY
+        found = len(questions)
+        spec = format_plan(questions)
+        plan = compile_plan("", spec)
+        # A plan that turns out plain is stored as a plain key
+        normalized = plan.key
+        if plan.simple:
+            spec = None
+    else:
+        normalized = normalize_answers(raw_key)
+        found = len(normalized)
     
-    if len(normalized) != target_n:
+    if found != target_n:
         await update.message.reply_text(
-            f"❌ Uzunlik noto'g'ri. {len(normalized)} ta harf topildi, {target_n} ta kerak.\n"
+            f"❌ Uzunlik noto'g'ri. {found} ta harf topildi, {target_n} ta kerak.\n"
             "Qaytadan yuboring yoki /cancel."
         )
         return ASK_ANSWER_KEY
         
     test_id = context.user_data['key_test_id']
-    db.update_test_answer_key(test_id, normalized)
+    await db.update_test_answer_key(test_id, normalized, spec)
+    test = await db.get_test_meta(test_id)
+    key_info = f"Kalit: {normalized}" + (f"\nReja: {spec}" if spec else "")
+    
+    if test and test.status in ('active', 'ended'):
+        # Key corrected after submissions came in: re-score them in the background
+        await update.message.reply_text(
+            f"✅ Test {test_id} kalitlari yangilandi.\n{key_info}\n\n"
+            "♻️ Yuborilgan javoblar qayta baholanmoqda..."
+        )
+        context.application.create_task(
+            regrade_test(context.bot, update.effective_chat.id, test_id, test.status)
+        )
+        return ConversationHandler.END
     
     keyboard = [
         [InlineKeyboardButton("▶️ Boshlash", callback_data=f"start_test_{test_id}")],
         [InlineKeyboardButton("🔙 Admin Panel", callback_data="admin_home")]
     ]
     await update.message.reply_text(
-        f"✅ Test {test_id} kalitlari saqlandi.\nKalit: {normalized}", 
+        f"✅ Test {test_id} kalitlari saqlandi.\n{key_info}", 
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     return ConversationHandler.END
 
+async def regrade_test(bot, chat_id, test_id, status):
+    """Re-scores a test's stored submissions against its corrected key and reports back."""
+    try:
+        count, last_id = await db.regrade_submissions(test_id)
+        # A submission graded against the old key may have been queued before
+        # the key changed and written after the scan passed its id. Batches
+        # flushed from now on are re-graded by the writer itself.
+        await submission_writer.wait_flushed()
+        extra, _ = await db.regrade_submissions(test_id, after_id=last_id)
+        count += extra
+    except Exception as e:
+        logger.error(f"Regrade of test #{test_id} failed: {e}")
+        await bot.send_message(chat_id=chat_id, text=f"❌ Test {test_id} qayta baholashda xatolik yuz berdi.")
+        return
+    if status == 'active':
+        # Scores changed under the live ranking: rebuild it
+        await load_index(test_id)
+    await bot.send_message(chat_id=chat_id, text=f"♻️ Test {test_id}: {count} ta javob qayta baholandi.")
+
 
 # --- Manage Tests ---
 async def manage_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    tests = db.get_all_tests(limit=10)
+    tests = await db.get_all_tests(limit=10)
     if not tests:
         await query.edit_message_text("Testlar topilmadi.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Orqaga", callback_data="admin_home")]]))
         return
@@ -237,7 +332,7 @@ async def manage_tests(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def view_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     target_test_id = int(query.data.split("_")[-1])
-    test = db.get_test(target_test_id)
+    test = await db.get_test(target_test_id)
     
     if not test:
         await query.answer("Test topilmadi", show_alert=True)
@@ -250,6 +345,15 @@ async def view_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Status: {test['status']}\n"
         f"Kalit: {'✅' if test['answer_key'] else '❌'}\n"
     )
+    if test['scoring_plan']:
+        info += f"Baholash: {escape(test['scoring_plan'])}\n"
+    
+    # Live top 5 for running tests, straight from the rank index
+    index = get_index(test['id']) if test['status'] == 'active' else None
+    if index is not None and index.loaded:
+        info += f"\nIshtirokchilar: {len(index)}\n"
+        for rank, full_name, percent, _ in index.top(5):
+            info += f"{rank}. {escape(full_name or '')} - {percent}%\n"
     
     buttons = []
     if test['status'] == 'draft':
@@ -259,6 +363,11 @@ async def view_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
     if test['status'] == 'active':
         buttons.append([InlineKeyboardButton("⏹ Yakunlash", callback_data=f"end_test_{test['id']}")])
+    
+    if test['status'] in ('active', 'ended'):
+        # Correcting the key re-scores everything already submitted
+        buttons.append([InlineKeyboardButton("✍️ Kalitni tuzatish", callback_data=f"set_key_{test['id']}")])
+        buttons.append([InlineKeyboardButton("🔍 Savollar tahlili", callback_data=f"item_analysis_{test['id']}")])
         
     buttons.append([InlineKeyboardButton("📊 Natijalar (Fayl)", callback_data=f"get_leaderboard_{test['id']}")])
     buttons.append([InlineKeyboardButton("🔙 Orqaga", callback_data="admin_manage_tests")])
@@ -269,7 +378,7 @@ async def view_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_test_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     test_id = int(query.data.split("_")[-1])
-    test = db.get_test(test_id)
+    test = await db.get_test(test_id)
     
     if not test['answer_key']:
         await query.answer("Kalit kiritilmagan!", show_alert=True)
@@ -278,7 +387,9 @@ async def start_test_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     now = datetime.now()
     end_at = now + timedelta(hours=test['duration_hours'])
     
-    db.start_test_db(test_id, now, end_at)
+    await db.start_test_db(test_id, now, end_at)
+    schedule_test_end(context.job_queue, test_id, end_at)
+    await load_index(test_id)
     await query.answer("Test Boshlandi!")
     await view_test(update, context)
 
@@ -286,7 +397,9 @@ async def end_test_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     test_id = int(query.data.split("_")[-1])
     
-    db.end_test_db(test_id)
+    await db.end_test_db(test_id)
+    cancel_test_jobs(context.job_queue, test_id)
+    drop_index(test_id)
     await query.answer("Test Yakunlandi.")
     # Show view again
     await view_test(update, context)
@@ -297,7 +410,7 @@ async def admin_leaderboard_menu(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     
-    tests = db.get_all_tests(limit=20)
+    tests = await db.get_all_tests(limit=20)
     if not tests:
         await query.edit_message_text("Testlar yo'q.")
         return
@@ -312,29 +425,82 @@ async def admin_leaderboard_menu(update: Update, context: ContextTypes.DEFAULT_T
 
 async def send_leaderboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    test_id = int(query.data.split("_")[-1])
-    
-    submissions = db.get_test_submissions(test_id)
-    test = db.get_test(test_id)
+    # get_leaderboard_<id> asks for a format, get_leaderboard_<id>_<fmt> sends the file
+    parts = query.data[len("get_leaderboard_"):].split("_")
+    test_id = int(parts[0])
+    fmt = parts[1] if len(parts) > 1 else None
     
-    if not submissions:
+    test = await db.get_test(test_id)
+    if not test or not await db.get_submission_count(test_id):
         await query.answer("Javoblar yo'q.", show_alert=True)
         return
+    
+    if fmt not in FORMATS:
+        await query.answer()
+        keyboard = [
+            [
+                InlineKeyboardButton("🌐 HTML", callback_data=f"get_leaderboard_{test_id}_html"),
+                InlineKeyboardButton("📗 Excel (XLSX)", callback_data=f"get_leaderboard_{test_id}_xlsx")
+            ],
+            [InlineKeyboardButton("🔙 Orqaga", callback_data="admin_leaderboard_menu")]
+        ]
+        await query.edit_message_text(
+            f"Test #{test_id} natijalari uchun formatni tanlang:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
         
     await query.answer("Fayl tayyorlanmoqda...")
     
-    html_content = generate_leaderboard_html(test['title'], submissions)
-    file_obj = BytesIO(html_content.encode('utf-8'))
-    file_obj.name = f"leaderboard_test_{test_id}.html"
+    # Rendered and uploaded once; resent by file_id until the results change
+    await send_leaderboard(
+        context.bot, update.effective_chat.id, test,
+        lambda count: f"📊 <b>{test['title']}</b> - Natijalar\nJami ishtirokchilar: {count}",
+        fmt=fmt
+    )
+
+# Questions whose discrimination index is below this get flagged
+WEAK_DISCRIMINATION = 0.2
+MAX_MESSAGE_LENGTH = 4096
+
+async def item_analysis_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    test_id = int(query.data.split("_")[-1])
+    test = await db.get_test(test_id)
     
-    caption = f"📊 <b>{test['title']}</b> - Natijalar\nJami ishtirokchilar: {len(submissions)}"
+    if not test or not test['answer_key'] or not await db.get_submission_count(test_id):
+        await query.answer("Javoblar yo'q.", show_alert=True)
+        return
     
-    await context.bot.send_document(
-        chat_id=update.effective_chat.id,
-        document=file_obj,
-        caption=caption,
-        parse_mode='HTML'
-    )
+    await query.answer("Tahlil tayyorlanmoqda...")
+    # Cached per test until a new submission or a key correction
+    analysis = await db.run_sync(compute_item_analysis, test)
+    
+    lines = [
+        f"🔍 <b>{escape(test['title'])}</b> - Savollar tahlili",
+        f"Ishtirokchilar: {analysis.participants} (yuqori/quyi guruh: {analysis.group_size})",
+        f"D - ajratish indeksi, ⚠️ - D < {WEAK_DISCRIMINATION}",
+        "",
+    ]
+    for item in item_rows(analysis):
+        flag = " ⚠️" if item['discrimination'] < WEAK_DISCRIMINATION else ""
+        options = " · ".join(f"{letter} {count}" for letter, count in item['options'].items())
+        if item['other']:
+            options += f" · ? {item['other']}"
+        lines.append(
+            f"<b>{item['question']}.</b> Kalit: {escape(item['key'])} | ✅ {item['correct_rate']}% | "
+            f"D: {item['discrimination']}{flag}\n    {options}"
+        )
+    
+    # Long tests don't fit in one message
+    text = ""
+    for line in lines:
+        if len(text) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+            await query.message.reply_text(text, parse_mode='HTML')
+            text = ""
+        text += line + "\n"
+    if text:
+        await query.message.reply_text(text, parse_mode='HTML')
 
 
 # --- Broadcast Feature ---
@@ -346,25 +512,15 @@ async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
-    users = db.get_all_users()
+    total = await db.get_user_count()
     
-    success_count = 0
-    fail_count = 0
+    status_msg = await message.reply_text(f"Yuborilmoqda... Jami: {total}")
     
-    status_msg = await update.message.reply_text(f"Yuborilmoqda... Jami: {len(users)}")
-    
-    for row in users:
-        user_id = row['tg_user_id']
-        try:
-            await message.copy(chat_id=user_id)
-            success_count += 1
-        except Exception:
-            fail_count += 1
-            
-    await status_msg.edit_text(
-        f"✅ Xabar yuborildi!\n\n"
-        f"Muvaffaqiyatli: {success_count}\n"
-        f"Xatolik: {fail_count}"
+    # Persisted campaign: sent in the background under the global rate limit,
+    # resumed after a restart; status_msg is updated as it progresses
+    campaign_id = await db.create_broadcast(
+        update.effective_chat.id, message.chat_id, message.message_id, status_msg.message_id, total
     )
+    await start_campaign(context.bot, campaign_id)
     
     return ConversationHandler.END
@@ -1,7 +1,12 @@
+import asyncio
+import logging
 from telegram import Update
 from telegram.ext import ContextTypes, ConversationHandler
+from db.cache import MISSING, TTLCache
 import config
 
+logger = logging.getLogger(__name__)
+
 # Conversation states
 ASK_TITLE, ASK_QUESTIONS, ASK_DURATION, ASK_CONFIRM, ASK_ANSWER_KEY = range(5)
 REGISTER_NAME, REGISTER_REGION = range(2)
@@ -16,22 +21,56 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("Amal bekor qilindi.")
     return ConversationHandler.END
 
-async def check_is_subscribed(bot, user_id: int) -> bool:
-    """Checks if the user is a member of the required channel."""
+# Channel membership cache. Members are re-checked rarely; non-members soon,
+# since they are usually about to join.
+_subscription_cache = TTLCache(maxsize=config.SUBSCRIPTION_CACHE_SIZE, ttl=config.SUBSCRIPTION_CACHE_TTL)
+_subscription_inflight = {}  # user_id -> Task shared by concurrent checks
+_subscription_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0}
+
+async def check_is_subscribed(bot, user_id: int, use_negative_cache: bool = True) -> bool:
+    """
+    Checks if the user is a member of the required channel.
+    Pass use_negative_cache=False when the user says they just joined, so a
+    cached "not a member" answer doesn't lock them out.
+    """
+    cached = _subscription_cache.get(user_id)
+    if cached is not MISSING and (cached or use_negative_cache):
+        _subscription_stats['hits'] += 1
+        return cached
+
+    # Single flight: concurrent checks for one user share one API call
+    task = _subscription_inflight.get(user_id)
+    if task is not None:
+        _subscription_stats['coalesced'] += 1
+    else:
+        _subscription_stats['misses'] += 1
+        task = asyncio.ensure_future(_fetch_subscription(bot, user_id))
+        _subscription_inflight[user_id] = task
+        task.add_done_callback(lambda _: _subscription_inflight.pop(user_id, None))
+    # Shield so one cancelled waiter doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+async def _fetch_subscription(bot, user_id: int) -> bool:
     try:
         member = await bot.get_chat_member(chat_id=config.REQUIRED_CHANNEL_ID, user_id=user_id)
-        # 'left' means they are not a member. 'kicked' means banned.
-        # 'creator', 'administrator', 'member', 'restricted' are valid (restricted depends, but usually implies presence)
-        if member.status in ['left', 'kicked']:
-            return False
-        return True
     except Exception as e:
-        # If bot is not admin in channel or ID is wrong, it might raise error. 
-        # Assume False or log error? For safety, let's log and assume True to not block users if config is wrong?
-        # No, strict mode: False. User implies they WANT to block.
-        # But if bot can't see the channel, it's a problem. 
-        # Let's assume False and let the user complain if it's broken configuration.
-        # Actually, better to print/log it.
-        print(f"Error checking subscription: {e}")
+        # If bot is not admin in channel or ID is wrong, it might raise error.
+        # Strict mode: treat as not subscribed, but don't cache it.
+        _subscription_stats['errors'] += 1
+        logger.error(f"Error checking subscription: {e}")
+        return False
+    # 'left' means they are not a member. 'kicked' means banned.
+    # 'creator', 'administrator', 'member', 'restricted' are valid (restricted depends, but usually implies presence)
+    if member.status in ['left', 'kicked']:
+        _subscription_cache.set(user_id, False, ttl=config.SUBSCRIPTION_CACHE_NEGATIVE_TTL)
         return False
+    _subscription_cache.set(user_id, True)
+    return True
 
+def subscription_cache_stats() -> dict:
+    """Counters for tuning the membership cache TTLs."""
+    stats = dict(_subscription_stats)
+    lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+    stats['hit_rate'] = (stats['hits'] + stats['coalesced']) / lookups if lookups else 0.0
+    stats['size'] = len(_subscription_cache)
+    return stats
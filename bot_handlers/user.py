@@ -1,8 +1,11 @@
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, MessageHandler, filters, CallbackQueryHandler
-import db.queries as db
+import db.async_queries as db
+from db.cache import get_key_version
+from db.writer import submission_writer
 from bot_handlers.common import REGISTER_NAME, REGISTER_REGION, check_is_subscribed
-from services.grader import normalize_answers, grade_submission
+from services.grader import normalize_answers, grade_with_plan
+from services.ranking import record_submission
 from datetime import datetime
 import config
 import logging
@@ -33,7 +36,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
-    db_user = db.get_user_by_tg_id(user.id)
+    db_user = await db.get_registered_user(user.id)
     
     if db_user:
         await update.message.reply_text(
@@ -58,10 +61,11 @@ async def check_subscription_callback(update: Update, context: ContextTypes.DEFA
     user = query.from_user
     await query.answer()
     
-    is_sub = await check_is_subscribed(context.bot, user.id)
+    # They say they just joined: don't trust a cached "not a member"
+    is_sub = await check_is_subscribed(context.bot, user.id, use_negative_cache=False)
     if is_sub:
         await query.message.delete()
-        db_user = db.get_user_by_tg_id(user.id)
+        db_user = await db.get_registered_user(user.id)
         if db_user:
             await context.bot.send_message(
                 chat_id=user.id,
@@ -108,7 +112,7 @@ async def register_region(update: Update, context: ContextTypes.DEFAULT_TYPE):
         region = None
         
     user = update.effective_user
-    db.upsert_user(user.id, user.username, context.user_data['full_name'], region)
+    await db.upsert_user(user.id, user.username, context.user_data['full_name'], region)
     
     await update.message.reply_text(
         "<b>Tabriklaymiz! Ro'yxatdan o'tish muvaffaqiyatli yakunlandi.</b> 🎉\n\n"
@@ -154,71 +158,86 @@ async def handle_submission(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check user/test/time logic same as before...
     user = update.effective_user
-    db_user = db.get_user_by_tg_id(user.id)
+    db_user = await db.get_registered_user(user.id)
     if not db_user:
         await update.message.reply_text("Iltimos, avval /start buyrug'ini bosing.")
         return
 
     test_id = int(test_id_str)
-    test = db.get_test(test_id)
+    # Read before the key itself: if the key changes after this, the writer re-grades
+    key_version = get_key_version(test_id)
+    # Cached metadata: validation below needs no database round-trip
+    test = await db.get_test_meta(test_id)
     
     if not test:
         await update.message.reply_text(f"❌ Test #{test_id} topilmadi.")
         return
         
-    if test['status'] != 'active':
-        await update.message.reply_text(f"Test #{test_id} faol emas (Status: {test['status']}).")
+    if test.status != 'active':
+        await update.message.reply_text(f"Test #{test_id} faol emas (Status: {test.status}).")
         return
         
-    if not test['answer_key']:
+    if not test.answer_key:
         await update.message.reply_text("Xatolik: Test kaliti yo'q.")
         return
 
     now = datetime.now()
-    if test['end_at'] and isinstance(test['end_at'], str):
-        end_at_dt = datetime.fromisoformat(test['end_at'])
-        if now > end_at_dt:
-             await update.message.reply_text("⏰ Test vaqti tugagan.")
-             return
-    elif test['end_at'] and now > test['end_at']: 
-         await update.message.reply_text("⏰ Test vaqti tugagan.")
-         return
+    if test.end_at and now > test.end_at:
+        await update.message.reply_text("⏰ Test vaqti tugagan.")
+        return
 
     normalized = normalize_answers(raw_answers)
     
-    if len(normalized) != test['num_questions']:
+    if len(normalized) != test.num_questions:
         await update.message.reply_text(
             f"❌ Javoblar soni noto'g'ri.\n"
-            f"Kutilgan: {test['num_questions']} ta\n"
+            f"Kutilgan: {test.num_questions} ta\n"
             f"Sizniki: {len(normalized)} ta"
         )
         return
 
-    existing = db.get_submission(test_id, db_user['id'])
-    if existing:
-        await update.message.reply_text(f"⚠️ Siz Test #{test_id} ga javob yuborgansiz.")
-        return
-
-    correct, wrong, percent = grade_submission(normalized, test['answer_key'])
+    # Plan tables were compiled once, when the test was cached
+    correct, wrong, percent = grade_with_plan(normalized, test.answer_key, test.plan)
     started_at = now
     time_taken = 0
     
-    success = db.create_submission(
-        test_id, db_user['id'], raw_answers, normalized, 
-        correct, wrong, percent, started_at, time_taken
-    )
+    # Queued for the next group commit; resolves once the row is durable,
+    # or with the earlier result if this is a duplicate
+    try:
+        inserted, sub = await submission_writer.submit(
+            test_id, db_user['id'], raw_answers, normalized, 
+            correct, wrong, percent, started_at, time_taken,
+            key_version=key_version
+        )
+    except Exception as e:
+        logger.error(f"Error creating submission: {e}")
+        await update.message.reply_text("Xatolik yuz berdi (Ma'lumotlar bazasi).")
+        return
     
-    if success:
+    if not inserted:
         await update.message.reply_text(
-            f"✅ <b>Test #{test_id} qabul qilindi!</b>\n\n"
-            f"🟢 To'g'ri: {correct} ta\n"
-            f"🔴 Noto'g'ri: {wrong} ta\n"
-            f"📊 Natija: {percent}%\n"
-            f"⏱ Vaqt: --:--",
-            parse_mode='HTML'
+            f"⚠️ Siz Test #{test_id} ga javob yuborgansiz.\n\n"
+            f"🟢 To'g'ri: {sub['correct_count']} ta\n"
+            f"📊 Natija: {sub['percent']}%"
         )
-    else:
-        await update.message.reply_text("Xatolik yuz berdi (Ma'lumotlar bazasi).")
+        return
+    
+    # The stored scores, in case the key changed and the writer re-graded it
+    correct, wrong, percent = sub['correct_count'], sub['wrong_count'], sub['percent']
+    
+    # Live rank from the in-memory index (absent while it is still loading)
+    ranked = record_submission(test_id, sub['id'], percent, correct, time_taken, db_user['full_name'])
+    rank_line = f"\n🏆 O'rningiz: #{ranked[0]} / {ranked[1]:,}" if ranked else ""
+    
+    await update.message.reply_text(
+        f"✅ <b>Test #{test_id} qabul qilindi!</b>\n\n"
+        f"🟢 To'g'ri: {correct} ta\n"
+        f"🔴 Noto'g'ri: {wrong} ta\n"
+        f"📊 Natija: {percent}%\n"
+        f"⏱ Vaqt: --:--"
+        f"{rank_line}",
+        parse_mode='HTML'
+    )
 
 async def handle_invalid_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
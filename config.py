@@ -16,7 +16,7 @@ for x in admin_ids_str.split(","):
 TIMEZONE = os.getenv("TIMEZONE", "UTC")
 
 # Database path (Backward compatibility or local fallback)
-DB_PATH = "bluebot.db"
+DB_PATH = os.getenv("DB_PATH", "bluebot.db")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 # FIX: Sanitize URL and force IPv4 resolution for Supabase on Railway
@@ -39,6 +39,71 @@ if DATABASE_URL:
     except Exception as e:
         logging.warning(f"Failed to resolve database hostname to IPv4: {e}")
 
+# Connection pool (PostgreSQL). SQLite keeps one connection per thread, see below.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))  # ping idle connections older than this
+# Worker threads running queries for the async handlers (db.async_queries)
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX)))
+
+# SQLite fallback. "wal": WAL journal, one writer thread, read-only connections
+# for everything else. Any other value keeps SQLite's default rollback journal.
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "wal").lower()
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # NORMAL is durable across app crashes in WAL mode
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "32768"))  # page cache per connection
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# In-process cache of test metadata used to validate submissions
+TEST_CACHE_TTL = float(os.getenv("TEST_CACHE_TTL", "30"))
+TEST_CACHE_SIZE = int(os.getenv("TEST_CACHE_SIZE", "256"))
+# Registered-user lookups by Telegram ID (negative = not registered yet)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+USER_CACHE_NEGATIVE_TTL = float(os.getenv("USER_CACHE_NEGATIVE_TTL", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+
+# Updates handled at the same time (one at a time per chat, in order)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+# Conversation states and user_data are saved to the database in batches this
+# often (seconds); a crash loses at most this much in-progress input
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "10"))
+
+# Group commit for submissions: flush when this many are queued, or after the delay
+SUBMISSION_BATCH_SIZE = int(os.getenv("SUBMISSION_BATCH_SIZE", "200"))
+SUBMISSION_BATCH_DELAY_MS = float(os.getenv("SUBMISSION_BATCH_DELAY_MS", "5"))
+
+# Broadcasts: global send rate (Telegram allows ~30 msg/s), parallel sends,
+# and recipients per persisted progress step
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "100"))
+BROADCAST_STATUS_INTERVAL = float(os.getenv("BROADCAST_STATUS_INTERVAL", "5"))  # seconds between status edits
+
+# Updates arrive by long polling unless WEBHOOK_URL (the public HTTPS base
+# URL, e.g. https://bot.example.com) is set. Then the bot runs its own HTTP
+# server on WEBHOOK_LISTEN:WEBHOOK_PORT behind a TLS-terminating proxy, and
+# Telegram must send WEBHOOK_SECRET with every request.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Parallel HTTPS connections Telegram opens to deliver updates (1-100). The
+# handler only queues the update, so more connections just means less waiting.
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
+
+# Latency histograms and error counters (services.metrics), served in the
+# Prometheus format on http://METRICS_LISTEN:METRICS_PORT/metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Tests end (and scheduled ones start) via one-shot jobs; this sweep only
+# catches what those missed, so it can be slow
+TEST_RECONCILE_INTERVAL = float(os.getenv("TEST_RECONCILE_INTERVAL", "900"))
+
 # Logging setup
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -52,3 +117,7 @@ if not BOT_TOKEN:
 # Channel Subscription
 REQUIRED_CHANNEL_ID = "-1002659222713"
 REQUIRED_CHANNEL_USERNAME = "BluePrep_Academy"
+# Cached get_chat_member results (seconds); non-members expire sooner
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "3600"))
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL", "15"))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "50000"))
@@ -0,0 +1,101 @@
+# Awaitable versions of db.queries for the async handlers. Each call runs on a
+# bounded thread pool so a database round-trip never blocks the event loop.
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+import db.queries as queries
+from db.cache import MISSING, test_cache, user_cache
+
+_executor = ThreadPoolExecutor(max_workers=config.DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+# Totals over every run_sync call: time spent waiting for a free worker
+# and time spent running on one
+_stats = {'calls': 0, 'wait_seconds': 0.0, 'busy_seconds': 0.0}
+_stats_lock = threading.Lock()
+
+def _timed(func, queued_at):
+    started = time.perf_counter()
+    try:
+        return func()
+    finally:
+        finished = time.perf_counter()
+        with _stats_lock:
+            _stats['calls'] += 1
+            _stats['wait_seconds'] += started - queued_at
+            _stats['busy_seconds'] += finished - started
+
+async def run_sync(func, *args, **kwargs):
+    """Runs a blocking callable on the database executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    return await loop.run_in_executor(_executor, _timed, call, time.perf_counter())
+
+def db_stats() -> dict:
+    """Snapshot of the executor counters (see _stats)."""
+    with _stats_lock:
+        return dict(_stats)
+
+def _wrap(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_sync(func, *args, **kwargs)
+    return wrapper
+
+def _cached(cache, load):
+    # Serve cache hits inline; only a miss is worth a trip to the executor
+    async def wrapper(key):
+        value = cache.get(key)
+        if value is MISSING:
+            value = await run_sync(load, key)
+        return value
+    wrapper.__name__ = load.__name__.replace("load_", "get_", 1)
+    return wrapper
+
+def shutdown():
+    _executor.shutdown(wait=True)
+    queries.close_pool()
+
+# --- User Queries ---
+upsert_user = _wrap(queries.upsert_user)
+get_user_by_tg_id = _wrap(queries.get_user_by_tg_id)
+get_registered_user = _cached(user_cache, queries.load_registered_user)
+get_all_users = _wrap(queries.get_all_users)
+get_user_count = _wrap(queries.get_user_count)
+
+# --- Test Queries ---
+create_test = _wrap(queries.create_test)
+get_test = _wrap(queries.get_test)
+get_test_meta = _cached(test_cache, queries.load_test_meta)
+update_test_answer_key = _wrap(queries.update_test_answer_key)
+start_test_db = _wrap(queries.start_test_db)
+end_test_db = _wrap(queries.end_test_db)
+get_active_tests_needing_end = _wrap(queries.get_active_tests_needing_end)
+get_active_tests = _wrap(queries.get_active_tests)
+get_scheduled_tests = _wrap(queries.get_scheduled_tests)
+get_all_tests = _wrap(queries.get_all_tests)
+
+# --- Submission Queries ---
+create_submission = _wrap(queries.create_submission)
+insert_submission = _wrap(queries.insert_submission)
+insert_submissions_batch = _wrap(queries.insert_submissions_batch)
+get_submission = _wrap(queries.get_submission)
+get_test_submissions = _wrap(queries.get_test_submissions)
+get_top_submissions = _wrap(queries.get_top_submissions)
+get_submission_count = _wrap(queries.get_submission_count)
+regrade_submissions = _wrap(queries.regrade_submissions)
+
+# --- Broadcast Queries ---
+create_broadcast = _wrap(queries.create_broadcast)
+get_broadcast = _wrap(queries.get_broadcast)
+get_running_broadcasts = _wrap(queries.get_running_broadcasts)
+get_broadcast_recipients = _wrap(queries.get_broadcast_recipients)
+update_broadcast_progress = _wrap(queries.update_broadcast_progress)
+finish_broadcast = _wrap(queries.finish_broadcast)
+
+# --- Bot Persistence ---
+load_user_data = _wrap(queries.load_user_data)
+load_conversations = _wrap(queries.load_conversations)
+save_persistence = _wrap(queries.save_persistence)
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+import config
+from services.grader import compile_plan
+
+# Returned by TTLCache.get on a miss, so a cached None can be told apart
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+    Used from both the event loop and the database executor threads.
+
+    Each invalidate() bumps the key's generation. A load reads generation()
+    before querying and passes it to set(), which then skips the write if an
+    invalidation happened meanwhile: the row it read may predate that write.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._generations = {}  # key -> invalidations so far
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def set(self, key, value, ttl=None, generation=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and generation != self._generations.get(key, 0):
+                return
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# --- Test metadata ---
+# Everything handle_submission needs to validate and grade a submission, with
+# end_at already parsed to a datetime (SQLite hands it back as an ISO string)
+# and the scoring plan compiled (None for a plain key).
+TestMeta = namedtuple("TestMeta", ["id", "title", "status", "num_questions", "answer_key", "end_at", "plan"])
+
+test_cache = TTLCache(maxsize=config.TEST_CACHE_SIZE, ttl=config.TEST_CACHE_TTL)
+
+def build_test_meta(row):
+    if row is None:
+        return None
+    end_at = row['end_at']
+    if end_at and isinstance(end_at, str):
+        end_at = datetime.fromisoformat(end_at)
+    return TestMeta(
+        id=row['id'],
+        title=row['title'],
+        status=row['status'],
+        num_questions=row['num_questions'],
+        answer_key=row['answer_key'],
+        end_at=end_at,
+        plan=compile_plan(row['answer_key'], row['scoring_plan']) if row['scoring_plan'] else None,
+    )
+
+
+# --- Registered users ---
+# tg_user_id -> {'id', 'full_name'}, or None for someone who hasn't registered.
+# Negative entries get a shorter TTL so a registration done by another
+# process shows up quickly; upsert_user overwrites them in this one.
+user_cache = TTLCache(maxsize=config.USER_CACHE_SIZE, ttl=config.USER_CACHE_TTL)
+
+def build_registered_user(row):
+    if row is None:
+        return None
+    return {'id': row['id'], 'full_name': row['full_name']}
+
+
+# --- Results versions ---
+# Bumped whenever a test's stored results change (new submission, regrade),
+# so artifacts built from them (leaderboard files) know when they are stale.
+_results_versions = {}
+_results_lock = threading.Lock()
+
+def get_results_version(test_id):
+    return _results_versions.get(test_id, 0)
+
+def bump_results_version(test_id):
+    with _results_lock:
+        _results_versions[test_id] = _results_versions.get(test_id, 0) + 1
+
+
+# --- Key versions ---
+# Bumped whenever a test's answer key or scoring plan changes, so a
+# submission graded against the old one can be caught before it is stored
+# (see db.writer.SubmissionWriter).
+_key_versions = {}
+
+def get_key_version(test_id):
+    return _key_versions.get(test_id, 0)
+
+def bump_key_version(test_id):
+    with _results_lock:
+        _key_versions[test_id] = _key_versions.get(test_id, 0) + 1
@@ -2,6 +2,7 @@ import sqlite3
 import psycopg2
 import logging
 from config import DB_PATH, DATABASE_URL
+from db.migrations import migrate
 
 logger = logging.getLogger(__name__)
 
@@ -42,7 +43,6 @@ def init_postgres():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
         ''')
-        
         # Submissions table
         c.execute('''
         CREATE TABLE IF NOT EXISTS submissions (
@@ -62,9 +62,28 @@ def init_postgres():
         )
         ''')
         
+        # Broadcast campaigns (progress is a keyset cursor over users.id)
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            admin_chat_id BIGINT NOT NULL,
+            from_chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            status_message_id BIGINT,
+            status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            last_user_id INTEGER DEFAULT 0,
+            sent_count INTEGER DEFAULT 0,
+            failed_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''')
+        
         conn.commit()
+        version = migrate(conn, postgres=True)
         conn.close()
-        logger.info("Database initialized successfully (PostgreSQL).")
+        logger.info(f"Database initialized successfully (PostgreSQL, schema version {version}).")
     except Exception as e:
         logger.error(f"Failed to initialize PostgreSQL: {e}")
 
@@ -98,7 +117,6 @@ def init_sqlite():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
-    
     # Submissions table
     c.execute('''
     CREATE TABLE IF NOT EXISTS submissions (
@@ -120,9 +138,28 @@ def init_sqlite():
     )
     ''')
     
+    # Broadcast campaigns (progress is a keyset cursor over users.id)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_chat_id INTEGER NOT NULL,
+        from_chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        status_message_id INTEGER,
+        status TEXT DEFAULT 'running', -- running, done
+        total INTEGER DEFAULT 0,
+        last_user_id INTEGER DEFAULT 0,
+        sent_count INTEGER DEFAULT 0,
+        failed_count INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    ''')
+    
     conn.commit()
+    version = migrate(conn, postgres=False)
     conn.close()
-    logger.info("Database initialized successfully (SQLite).")
+    logger.info(f"Database initialized successfully (SQLite, schema version {version}).")
 
 if __name__ == "__main__":
     init_db()
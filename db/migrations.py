@@ -0,0 +1,173 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The CREATE TABLE statements in init_db are the baseline schema (version 0).
+# Every later change is a numbered migration below; applied versions are
+# recorded in schema_migrations so each one runs exactly once per database.
+# Never edit or renumber a migration that has shipped, add a new one instead.
+
+MIGRATIONS = []  # [(version, description, apply(cursor, postgres), outside_transaction)]
+
+# Arbitrary key for pg_advisory_xact_lock: one migrating process at a time
+MIGRATION_LOCK_ID = 8_107_319
+
+def migration(version, description, outside_transaction=False):
+    """
+    outside_transaction: on PostgreSQL, run it in autocommit mode under a
+    session advisory lock, for statements such as CREATE INDEX CONCURRENTLY
+    that refuse to run inside a transaction block.
+    """
+    def register(apply):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, "migrations must be added in order"
+        MIGRATIONS.append((version, description, apply, outside_transaction))
+        return apply
+    return register
+
+
+@migration(1, "tests(status, end_at) index for the expiry poll")
+def _index_tests_status_end_at(c, postgres):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tests_status_end_at ON tests (status, end_at)")
+
+
+@migration(2, "tests(created_at) index for the admin lists")
+def _index_tests_created_at(c, postgres):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tests_created_at ON tests (created_at)")
+
+
+@migration(3, "covering leaderboard index on submissions", outside_transaction=True)
+def _index_submissions_leaderboard(c, postgres):
+    # Matches LEADERBOARD_ORDER, so leaderboards are read in index order with
+    # no sort. The rest of the leaderboard's submission columns ride along:
+    # as INCLUDE columns on PostgreSQL, as trailing key columns on SQLite.
+    if postgres:
+        # Built CONCURRENTLY so a deploy onto a busy database doesn't block
+        # submissions while it scans the table. A failed concurrent build
+        # leaves an invalid index behind that IF NOT EXISTS would skip over.
+        c.execute('''
+            SELECT 1 FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid
+            WHERE ic.relname = 'idx_submissions_leaderboard' AND NOT i.indisvalid
+        ''')
+        if c.fetchone():
+            c.execute("DROP INDEX CONCURRENTLY idx_submissions_leaderboard")
+        c.execute('''
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_submissions_leaderboard
+            ON submissions (test_id, percent DESC, correct_count DESC, time_taken_seconds)
+            INCLUDE (id, user_id, wrong_count, submitted_at)
+        ''')
+    else:
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_submissions_leaderboard
+            ON submissions (test_id, percent DESC, correct_count DESC, time_taken_seconds,
+                            id, user_id, wrong_count, submitted_at)
+        ''')
+
+
+@migration(4, "tests.scoring_plan column")
+def _add_tests_scoring_plan(c, postgres):
+    if postgres:
+        c.execute("ALTER TABLE tests ADD COLUMN IF NOT EXISTS scoring_plan TEXT")
+        return
+    c.execute("PRAGMA table_info(tests)")
+    if 'scoring_plan' not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE tests ADD COLUMN scoring_plan TEXT")
+
+
+@migration(5, "user_data and conversation_states tables for bot persistence")
+def _create_persistence_tables(c, postgres):
+    # JSON-encoded; see services.persistence
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id BIGINT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            name TEXT NOT NULL,
+            conv_key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, conv_key)
+        )
+    ''')
+
+
+def _applied_versions(c):
+    c.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in c.fetchall()}
+
+def _record(c, version, description, postgres):
+    ph = '%s' if postgres else '?'
+    c.execute(
+        f"INSERT INTO schema_migrations (version, description) VALUES ({ph}, {ph})",
+        (version, description)
+    )
+
+def _migrate_outside_transaction(conn, c, version, description, apply):
+    # PostgreSQL only. Returns False if another process applied it first.
+    conn.commit()
+    conn.autocommit = True
+    try:
+        c.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            if version in _applied_versions(c):
+                return False
+            apply(c, True)
+            _record(c, version, description, True)
+            return True
+        finally:
+            c.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    finally:
+        conn.autocommit = False
+
+def migrate(conn, postgres):
+    """
+    Applies pending migrations in order, each in its own transaction along
+    with its schema_migrations row (outside_transaction ones on PostgreSQL
+    excepted: they run in autocommit mode). Safe to run from several
+    processes at once: PostgreSQL takes an advisory lock, SQLite a write
+    lock, and the applied versions are re-read under the lock. Returns the
+    schema version.
+    """
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    applied = _applied_versions(c)
+    for version, description, apply, outside_transaction in MIGRATIONS:
+        if version in applied:
+            continue
+        if postgres and outside_transaction:
+            try:
+                if _migrate_outside_transaction(conn, c, version, description, apply):
+                    logger.info(f"Applied migration {version}: {description}")
+            except Exception:
+                logger.error(f"Migration {version} ({description}) failed")
+                raise
+            applied.add(version)
+            continue
+        if postgres:
+            c.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        else:
+            c.execute("BEGIN IMMEDIATE")
+        applied = _applied_versions(c)
+        if version not in applied:
+            try:
+                apply(c, postgres)
+                _record(c, version, description, postgres)
+            except Exception:
+                conn.rollback()
+                logger.error(f"Migration {version} ({description}) failed")
+                raise
+            logger.info(f"Applied migration {version}: {description}")
+            applied.add(version)
+        conn.commit()
+    return max(applied, default=0)
@@ -0,0 +1,264 @@
+import sqlite3
+import threading
+import time
+import logging
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free within the checkout timeout."""
+
+
+class PostgresPool:
+    """
+    Thread-safe PostgreSQL connection pool.
+
+    Keeps between `minconn` and `maxconn` open connections. A checkout blocks
+    for at most `timeout` seconds when all connections are in use. Connections
+    that sat idle longer than `healthcheck_interval` are pinged with SELECT 1
+    before being handed out, so dead sockets (Supabase idle kills, network
+    blips) are replaced instead of failing the caller's query.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=10.0, healthcheck_interval=30.0):
+        if minconn > maxconn:
+            raise ValueError("minconn must not exceed maxconn")
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, last_used_monotonic)
+        self._size = 0  # open connections, idle + checked out
+        self._closed = False
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Discarding unhealthy pooled connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            f"No database connection available within {self.timeout}s "
+                            f"(pool size {self.maxconn})"
+                        )
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    # Reserve the slot before connecting outside the lock
+                    self._size += 1
+                    conn = None
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            try:
+                # Never hand out a connection with a half-finished transaction
+                conn.rollback()
+            except Exception:
+                close = True
+        if close or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._size -= 1
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def run_write(self, func, *args, **kwargs):
+        # PostgreSQL handles concurrent writers itself
+        return func(*args, **kwargs)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._size -= 1
+            self._cond.notify_all()
+
+
+class SQLitePool:
+    """
+    One persistent SQLite connection per thread.
+
+    sqlite3 connections must not be shared across threads, and opening the
+    file is cheap but not free, so each thread keeps its own connection for
+    its whole lifetime.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def getconn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._all.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if conn.in_transaction:
+            conn.rollback()
+        if close:
+            conn.close()
+            self._local.conn = None
+            with self._lock:
+                if conn in self._all:
+                    self._all.remove(conn)
+
+    def run_write(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def closeall(self):
+        with self._lock:
+            for conn in self._all:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._all.clear()
+        self._local = threading.local()
+
+
+class SQLiteWALPool(SQLitePool):
+    """
+    SQLite tuned for a busy bot: WAL journal, and every write runs on one
+    dedicated writer thread.
+
+    In WAL mode readers never block the writer or each other, so the only
+    contention left is between writers. Funnelling all writes through
+    run_write() onto a single thread removes that too: no "database is
+    locked" under load. Every other thread gets its own read-only
+    connection, opened on first use. busy_timeout still covers other
+    processes (scripts, benchmarks) touching the same file.
+    """
+
+    def __init__(self, path, synchronous="NORMAL", cache_size_kb=32768, mmap_size=0, busy_timeout_ms=5000):
+        super().__init__(path)
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        # Escaped, so a path with "?", "#" or "%" in it can't be read as URI syntax
+        self._reader_uri = Path(path).resolve().as_uri() + "?mode=ro"
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        # Open the writer first: it switches the file to WAL before any reader connects
+        self._writer_conn = None
+        self._writer_thread = self._writer.submit(self._open_writer).result()
+
+    def _tune(self, conn):
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return conn
+
+    def _open_writer(self):
+        conn = self._tune(sqlite3.connect(self.path))
+        mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if mode.lower() != "wal":
+            logger.warning(f"SQLite refused WAL mode, using {mode}")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        self._writer_conn = conn
+        return threading.current_thread()
+
+    def _connect(self):
+        # Readers may be closed by closeall() from another thread
+        conn = sqlite3.connect(self._reader_uri, uri=True, check_same_thread=False)
+        self._tune(conn)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def getconn(self):
+        if threading.current_thread() is self._writer_thread:
+            return self._writer_conn
+        return super().getconn()
+
+    def putconn(self, conn, close=False):
+        if conn is self._writer_conn:
+            if conn.in_transaction:
+                conn.rollback()
+            return
+        super().putconn(conn, close)
+
+    def run_write(self, func, *args, **kwargs):
+        """Runs func on the writer thread and waits for its result."""
+        if threading.current_thread() is self._writer_thread:
+            return func(*args, **kwargs)
+        return self._writer.submit(func, *args, **kwargs).result()
+
+    def closeall(self):
+        if self._writer_conn is not None:
+            self._writer.submit(self._writer_conn.close).result()
+            self._writer_conn = None
+        self._writer.shutdown(wait=True)
+        super().closeall()
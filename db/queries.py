@@ -1,30 +1,103 @@
 import sqlite3
+import threading
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from config import DB_PATH, DATABASE_URL
+import itertools
+import functools
+from psycopg2.extras import execute_values, RealDictCursor
+from contextlib import contextmanager
+from config import (
+    DB_PATH, DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_INTERVAL,
+    USER_CACHE_NEGATIVE_TTL, SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE_KB,
+    SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT_MS,
+)
+from db.pool import PostgresPool, SQLitePool, SQLiteWALPool
+from services.grader import compile_plan, grade_batch
+from services.metrics import timed_query
+from db.cache import (
+    MISSING, test_cache, build_test_meta, user_cache, build_registered_user, bump_results_version,
+    bump_key_version,
+)
 from datetime import datetime
 import logging
 
 logger = logging.getLogger(__name__)
 
+_pool = None
+_pool_lock = threading.Lock()
+_cursor_ids = itertools.count(1)
+
+def get_pool():
+    """Returns the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if DATABASE_URL:
+                    _pool = PostgresPool(
+                        DATABASE_URL,
+                        minconn=DB_POOL_MIN,
+                        maxconn=DB_POOL_MAX,
+                        timeout=DB_POOL_TIMEOUT,
+                        healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL,
+                    )
+                elif SQLITE_JOURNAL_MODE == "wal":
+                    _pool = SQLiteWALPool(
+                        DB_PATH,
+                        synchronous=SQLITE_SYNCHRONOUS,
+                        cache_size_kb=SQLITE_CACHE_SIZE_KB,
+                        mmap_size=SQLITE_MMAP_SIZE,
+                        busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+                    )
+                else:
+                    _pool = SQLitePool(DB_PATH)
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+@contextmanager
 def get_connection():
-    if DATABASE_URL:
-        return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    else:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+    """
+    Checks a connection out of the pool for the duration of the block.
+    Uncommitted work is rolled back when the block exits, and a connection
+    that broke mid-query is dropped instead of going back to the pool.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+
+def _write(func):
+    """
+    Marks a query that writes. On the SQLite WAL pool it runs on the single
+    writer thread (the caller blocks until it is done); elsewhere it runs
+    in place. Goes above @timed_query, so waiting for the writer isn't
+    counted as query time.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return get_pool().run_write(func, *args, **kwargs)
+    return wrapper
 
 def get_ph():
     """Returns the placeholder string based on DB type."""
     return '%s' if DATABASE_URL else '?'
 
 # --- User Queries ---
+@_write
+@timed_query
 def upsert_user(tg_user_id, username, full_name, region=None):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    
     sql = f'''
         INSERT INTO users (tg_user_id, username, full_name, region)
         VALUES ({ph}, {ph}, {ph}, {ph})
@@ -32,213 +105,609 @@ def upsert_user(tg_user_id, username, full_name, region=None):
         username=excluded.username,
         full_name=excluded.full_name,
         region=COALESCE(excluded.region, users.region)
+        RETURNING id
     '''
-    
-    try:
-        if DATABASE_URL:
-            sql += " RETURNING id"
-            c.execute(sql, (tg_user_id, username, full_name, region))
-            user_id = c.fetchone()['id']
-        else:
-            c.execute(sql, (tg_user_id, username, full_name, region))
-            user_id = c.lastrowid
-            if not user_id:
-                c.execute(f'SELECT id FROM users WHERE tg_user_id = {ph}', (tg_user_id,))
-                res = c.fetchone()
-                user_id = res['id'] if res else None
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        # RETURNING on SQLite too: connections are long-lived, so after the
+        # UPDATE branch lastrowid still holds an earlier INSERT's rowid
+        c.execute(sql, (tg_user_id, username, full_name, region))
+        row = c.fetchone()
+        user_id = row['id'] if row else None
         conn.commit()
-    finally:
-        conn.close()
+    # Overwrites any negative entry cached before the user registered
+    if user_id:
+        user_cache.set(tg_user_id, build_registered_user({'id': user_id, 'full_name': full_name}))
+    else:
+        user_cache.invalidate(tg_user_id)
     return user_id
 
+@timed_query
 def get_user_by_tg_id(tg_user_id):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    c.execute(f'SELECT * FROM users WHERE tg_user_id = {ph}', (tg_user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT * FROM users WHERE tg_user_id = {ph}', (tg_user_id,))
+        return c.fetchone()
+
+def get_registered_user(tg_user_id):
+    """Cached {'id', 'full_name'} for a registered Telegram user, else None."""
+    user = user_cache.get(tg_user_id)
+    if user is MISSING:
+        user = load_registered_user(tg_user_id)
+    return user
+
+@timed_query
+def load_registered_user(tg_user_id):
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT id, full_name FROM users WHERE tg_user_id = {ph}', (tg_user_id,))
+        user = build_registered_user(c.fetchone())
+    user_cache.set(tg_user_id, user, ttl=None if user else USER_CACHE_NEGATIVE_TTL)
+    return user
 
+@timed_query
 def get_all_users():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users") # sqlite3.Row / RealDictCursor access by key 'tg_user_id' if needed, but here we perform broadcast
-    rows = cursor.fetchall()
-    conn.close()
-    # Return rows as dicts to be safe or list of dicts
-    # In original code it returned IDs? no, send_broadcast iterated rows.
-    # Original: return [row['id'] for row in rows] -> Actually send_broadcast used:
-    # row['tg_user_id']
-    # Wait, original get_all_users returned list of IDs?
-    # Let's check send_broadcast usage.
-    # send_broadcast(update...) calls db.get_all_users()
-    # It iterates 'users'.
-    # Previous implementation: return [row['id'] for row in rows]
-    # Wait, send_broadcast used: users = db.get_all_users(); for row in users: user_id = row['tg_user_id']
-    # If get_all_users returned list of IDs, then row['tg_user_id'] would fail.
-    # Checking previous code... 
-    # Previous code: return [row['id'] for row in rows]
-    # But send_broadcast: users = db.get_all_users() ... for row in users: user_id = row['tg_user_id']
-    # This implies the previous code was BROKEN or I misread it.
-    # Let's look at previous file content in Step 280.
-    # 44:    return [row['id'] for row in rows]
-    # 333:   users = db.get_all_users()
-    # 340:   for row in users:
-    # 341:       user_id = row['tg_user_id']
-    # This confirms the previous code was indeed buggy (integers don't have subscripts).
-    # Since I am rewriting it, I will fix it to return the full rows or at least tg_user_id.
-    
-    # Correction: I will return list of dicts/Rows with tg_user_id.
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT tg_user_id FROM users")
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    # send_broadcast reads row['tg_user_id'], so return rows rather than bare IDs.
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT tg_user_id FROM users")
+        return cursor.fetchall()
 
+@timed_query
 def get_user_count() -> int:
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM users")
-    # psycopg2 RealDictCursor fetchone returns dict {'count': N} ?? No, COUNT(*) name is unpredictable unless aliased?
-    # Actually RealDictCursor preserves column names. COUNT(*) might be 'count'.
-    # sqlite3 fetchone()[0] works.
-    # To be safe, use alias.
-    if DATABASE_URL:
-        # Postgres RealDictCursor
-        cursor.execute("SELECT COUNT(*) as c FROM users")
-        res = cursor.fetchone()
-        count = res['c']
-    else:
-        # SQLite
-        cursor.execute("SELECT COUNT(*) FROM users")
-        count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    # Alias the column: RealDictCursor keys rows by column name.
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) AS c FROM users")
+        return cursor.fetchone()['c']
 
 # --- Test Queries ---
+@_write
+@timed_query
 def create_test(title, num_questions, duration_hours):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    
     sql = f'''
         INSERT INTO tests (title, num_questions, duration_hours, status)
         VALUES ({ph}, {ph}, {ph}, 'draft')
     '''
-    
-    if DATABASE_URL:
-        sql += " RETURNING id"
-        c.execute(sql, (title, num_questions, duration_hours))
-        test_id = c.fetchone()['id']
-    else:
-        c.execute(sql, (title, num_questions, duration_hours))
-        test_id = c.lastrowid
-        
-    conn.commit()
-    conn.close()
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        if DATABASE_URL:
+            sql += " RETURNING id"
+            c.execute(sql, (title, num_questions, duration_hours))
+            test_id = c.fetchone()['id']
+        else:
+            c.execute(sql, (title, num_questions, duration_hours))
+            test_id = c.lastrowid
+        conn.commit()
+    # A student may have tried this ID before it existed
+    test_cache.invalidate(test_id)
     return test_id
 
+@timed_query
 def get_test(test_id):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    c.execute(f'SELECT * FROM tests WHERE id = {ph}', (test_id,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT * FROM tests WHERE id = {ph}', (test_id,))
+        return c.fetchone()
+
+def get_test_meta(test_id):
+    """
+    Cached TestMeta for the submission hot path (None if the test doesn't exist).
+    Writes below invalidate the entry; the TTL bounds staleness across processes.
+    """
+    meta = test_cache.get(test_id)
+    if meta is MISSING:
+        meta = load_test_meta(test_id)
+    return meta
+
+@timed_query
+def load_test_meta(test_id):
+    """Reads the test row and (re)fills its cache entry."""
+    generation = test_cache.generation(test_id)
+    meta = build_test_meta(get_test(test_id))
+    # Not cached if a write invalidated the entry while the row was being read
+    test_cache.set(test_id, meta, generation=generation)
+    return meta
 
-def update_test_answer_key(test_id, answer_key):
-    conn = get_connection()
-    c = conn.cursor()
+@_write
+@timed_query
+def update_test_answer_key(test_id, answer_key, scoring_plan=None):
     ph = get_ph()
-    c.execute(f'UPDATE tests SET answer_key = {ph} WHERE id = {ph}', (answer_key, test_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            f'UPDATE tests SET answer_key = {ph}, scoring_plan = {ph} WHERE id = {ph}',
+            (answer_key, scoring_plan, test_id)
+        )
+        conn.commit()
+    test_cache.invalidate(test_id)
+    bump_key_version(test_id)
 
+@_write
+@timed_query
 def start_test_db(test_id, start_at, end_at):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    c.execute(f'''
-        UPDATE tests 
-        SET status = 'active', start_at = {ph}, end_at = {ph}
-        WHERE id = {ph}
-    ''', (start_at, end_at, test_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            UPDATE tests
+            SET status = 'active', start_at = {ph}, end_at = {ph}
+            WHERE id = {ph}
+        ''', (start_at, end_at, test_id))
+        conn.commit()
+    test_cache.invalidate(test_id)
 
+@_write
+@timed_query
 def end_test_db(test_id):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    c.execute(f"UPDATE tests SET status = 'ended' WHERE id = {ph}", (test_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"UPDATE tests SET status = 'ended' WHERE id = {ph}", (test_id,))
+        conn.commit()
+    test_cache.invalidate(test_id)
 
+@timed_query
 def get_active_tests_needing_end(current_time):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    c.execute(f'''
-        SELECT * FROM tests 
-        WHERE status = 'active' AND end_at <= {ph}
-    ''', (current_time,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT * FROM tests
+            WHERE status = 'active' AND end_at <= {ph}
+        ''', (current_time,))
+        return c.fetchall()
+
+@timed_query
+def get_active_tests():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM tests WHERE status = 'active'")
+        return c.fetchall()
+
+@timed_query
+def get_scheduled_tests():
+    """Drafts with a start_at set: they start on their own at that time."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM tests WHERE status = 'draft' AND start_at IS NOT NULL")
+        return c.fetchall()
 
+@timed_query
 def get_all_tests(limit=20):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    c.execute(f'SELECT * FROM tests ORDER BY created_at DESC LIMIT {ph}', (limit,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT * FROM tests ORDER BY created_at DESC LIMIT {ph}', (limit,))
+        return c.fetchall()
 
 # --- Submission Queries ---
+@_write
+@timed_query
 def create_submission(test_id, user_id, raw, normalized, correct, wrong, percent, started_at, time_taken):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    
-    try:
-        c.execute(f'''
-            INSERT INTO submissions (test_id, user_id, raw_answers, normalized_answers, correct_count, wrong_count, percent, started_at, time_taken_seconds)
-            VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
-        ''', (test_id, user_id, raw, normalized, correct, wrong, percent, started_at, time_taken))
+    with get_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute(f'''
+                INSERT INTO submissions (test_id, user_id, raw_answers, normalized_answers, correct_count, wrong_count, percent, started_at, time_taken_seconds)
+                VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+            ''', (test_id, user_id, raw, normalized, correct, wrong, percent, started_at, time_taken))
+            conn.commit()
+            bump_results_version(test_id)
+            return True
+        except (sqlite3.IntegrityError, psycopg2.IntegrityError):
+            return False
+        except Exception as e:
+            logger.error(f"Error creating submission: {e}")
+            return False
+
+@_write
+@timed_query
+def insert_submission(test_id, user_id, raw, normalized, correct, wrong, percent, started_at, time_taken):
+    """
+    Inserts a submission unless the user already submitted for this test.
+    Returns (inserted, row) where row has id, correct_count, wrong_count and
+    percent of the new submission, or of the existing one for a duplicate.
+    The duplicate check and the insert are a single atomic statement.
+    """
+    ph = get_ph()
+    params = (test_id, user_id, raw, normalized, correct, wrong, percent, started_at, time_taken)
+    insert_sql = f'''
+        INSERT INTO submissions (test_id, user_id, raw_answers, normalized_answers, correct_count, wrong_count, percent, started_at, time_taken_seconds)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+        ON CONFLICT (test_id, user_id) DO NOTHING
+        RETURNING id, correct_count, wrong_count, percent
+    '''
+    existing_sql = f'''
+        SELECT id, correct_count, wrong_count, percent FROM submissions
+        WHERE test_id = {ph} AND user_id = {ph}
+    '''
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        if DATABASE_URL:
+            # The existing row comes back in the same round-trip when nothing was inserted
+            c.execute(f'''
+                WITH ins AS ({insert_sql})
+                SELECT id, correct_count, wrong_count, percent, TRUE AS inserted FROM ins
+                UNION ALL
+                SELECT id, correct_count, wrong_count, percent, FALSE AS inserted FROM submissions
+                WHERE test_id = {ph} AND user_id = {ph} AND NOT EXISTS (SELECT 1 FROM ins)
+            ''', params + (test_id, user_id))
+            row = c.fetchone()
+            conn.commit()
+            if row is not None:
+                inserted = row.pop('inserted')
+                if inserted:
+                    bump_results_version(test_id)
+                return inserted, row
+        else:
+            c.execute(insert_sql, params)
+            row = c.fetchone()
+            conn.commit()
+            if row is not None:
+                bump_results_version(test_id)
+                return True, row
+
+        # Duplicate whose row wasn't visible to the statement above (it was
+        # committed concurrently, or this is SQLite): read it back.
+        c.execute(existing_sql, (test_id, user_id))
+        return False, c.fetchone()
+
+@_write
+@timed_query
+def insert_submissions_batch(rows):
+    """
+    Group-commit version of insert_submission for many rows at once.
+    rows: list of insert_submission argument tuples. Returns a list of
+    (inserted, row) in the same order. Everything is written in one
+    transaction with a single commit. When the batch itself holds two rows
+    for the same (test_id, user_id), the first one wins.
+    """
+    ph = get_ph()
+    returning = "id, test_id, user_id, correct_count, wrong_count, percent"
+    columns = "test_id, user_id, raw_answers, normalized_answers, correct_count, wrong_count, percent, started_at, time_taken_seconds"
+
+    first = {}  # (test_id, user_id) -> index of its first row in the batch
+    for i, params in enumerate(rows):
+        first.setdefault((params[0], params[1]), i)
+    unique_rows = [rows[i] for i in first.values()]
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        if DATABASE_URL:
+            inserted_rows = execute_values(c, f'''
+                INSERT INTO submissions ({columns}) VALUES %s
+                ON CONFLICT (test_id, user_id) DO NOTHING
+                RETURNING {returning}
+            ''', unique_rows, page_size=len(unique_rows), fetch=True)
+        else:
+            inserted_rows = []
+            for params in unique_rows:
+                c.execute(f'''
+                    INSERT INTO submissions ({columns})
+                    VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+                    ON CONFLICT (test_id, user_id) DO NOTHING
+                    RETURNING {returning}
+                ''', params)
+                row = c.fetchone()
+                if row is not None:
+                    inserted_rows.append(row)
         conn.commit()
-        return True
-    except (sqlite3.IntegrityError, psycopg2.IntegrityError):
-        return False
-    except Exception as e:
-        logger.error(f"Error creating submission: {e}")
-        return False
-    finally:
-        conn.close()
 
+        inserted = {(r['test_id'], r['user_id']): r for r in inserted_rows}
+        for test_id in {key[0] for key in inserted}:
+            bump_results_version(test_id)
+        existing = {}
+        missing = [key for key in first if key not in inserted]
+        if missing:
+            values = ", ".join(f"({ph}, {ph})" for _ in missing)
+            c.execute(f'''
+                SELECT {returning} FROM submissions
+                WHERE (test_id, user_id) IN (VALUES {values})
+            ''', [v for key in missing for v in key])
+            existing = {(r['test_id'], r['user_id']): r for r in c.fetchall()}
+
+    results = []
+    for i, params in enumerate(rows):
+        key = (params[0], params[1])
+        if key in inserted and first[key] == i:
+            results.append((True, inserted[key]))
+        else:
+            results.append((False, inserted.get(key) or existing.get(key)))
+    return results
+
+@timed_query
 def get_submission(test_id, user_id):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    c.execute(f'SELECT * FROM submissions WHERE test_id = {ph} AND user_id = {ph}', (test_id, user_id))
-    row = c.fetchone()
-    conn.close()
-    return row
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT * FROM submissions WHERE test_id = {ph} AND user_id = {ph}', (test_id, user_id))
+        return c.fetchone()
 
+@timed_query
 def get_test_submissions(test_id):
-    conn = get_connection()
-    c = conn.cursor()
     ph = get_ph()
-    c.execute(f'''
-        SELECT s.*, u.full_name, u.username 
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT s.*, u.full_name, u.username
+            FROM submissions s
+            JOIN users u ON s.user_id = u.id
+            WHERE s.test_id = {ph}
+            ORDER BY s.percent DESC, s.correct_count DESC, s.time_taken_seconds ASC
+        ''', (test_id,))
+        return c.fetchall()
+
+@_write
+def _regrade_chunk(test_id, after_id, chunk_size):
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        # The key as of this transaction, so a chunk never writes scores for a
+        # key that was replaced before it ran. On PostgreSQL the row lock makes
+        # a key change wait for the chunk; on SQLite writes are serialized anyway.
+        lock = " FOR SHARE" if DATABASE_URL else ""
+        c.execute(f'SELECT answer_key, scoring_plan FROM tests WHERE id = {ph}{lock}', (test_id,))
+        test = c.fetchone()
+        if not test or not test['answer_key']:
+            return 0, after_id
+        plan = compile_plan(test['answer_key'], test['scoring_plan']) if test['scoring_plan'] else None
+        c.execute(f'''
+            SELECT id, normalized_answers FROM submissions
+            WHERE test_id = {ph} AND id > {ph}
+            ORDER BY id
+            LIMIT {ph}
+        ''', (test_id, after_id, chunk_size))
+        rows = c.fetchall()
+        if not rows:
+            return 0, after_id
+        correct, wrong, percent = grade_batch(test['answer_key'], [r['normalized_answers'] or "" for r in rows], plan=plan)
+        params = [
+            (int(cc), int(ww), float(pp), r['id'])
+            for cc, ww, pp, r in zip(correct, wrong, percent, rows)
+        ]
+        if DATABASE_URL:
+            execute_values(c, '''
+                UPDATE submissions AS s
+                SET correct_count = v.correct, wrong_count = v.wrong, percent = v.percent
+                FROM (VALUES %s) AS v(correct, wrong, percent, id)
+                WHERE s.id = v.id
+            ''', params, page_size=len(params))
+        else:
+            c.executemany(
+                "UPDATE submissions SET correct_count = ?, wrong_count = ?, percent = ? WHERE id = ?",
+                params
+            )
+        conn.commit()
+    return len(rows), rows[-1]['id']
+
+@timed_query
+def regrade_submissions(test_id, chunk_size=2000, after_id=0):
+    """
+    Re-scores a test's stored submissions with id > after_id against its
+    current answer key and plan, e.g. after the key was corrected. Each
+    chunk reads the key afresh, so overlapping regrades after two quick
+    corrections both end up writing the newest key's scores. Returns (number re-scored, last id seen), so a caller can catch up on
+    rows that arrived meanwhile.
+
+    Rows are read in id-keyset chunks and each chunk is its own transaction.
+    On the SQLite WAL pool that lets live submissions get onto the writer
+    thread between chunks instead of waiting for the whole test; the price
+    is that readers may briefly see a mix of old and new scores, and a
+    failure part-way leaves the earlier chunks re-scored (running it again
+    is harmless).
+    """
+    updated = 0
+    last_id = after_id
+    while True:
+        count, last_id = _regrade_chunk(test_id, last_id, chunk_size)
+        if not count:
+            break
+        updated += count
+    bump_results_version(test_id)
+    return updated, last_id
+
+LEADERBOARD_COLUMNS = '''
+    s.id, s.user_id, s.correct_count, s.wrong_count, s.percent, s.time_taken_seconds, s.submitted_at,
+    u.full_name, u.username, u.region
+'''
+LEADERBOARD_ORDER = "s.percent DESC, s.correct_count DESC, s.time_taken_seconds ASC"
+
+@timed_query
+def iter_test_submissions(test_id, chunk_size=1000, with_answers=False, by_region=False):
+    """
+    Yields a test's submissions in leaderboard order without loading them
+    all at once: a server-side cursor on PostgreSQL, fetchmany on SQLite.
+    Holds a pooled connection until the generator is exhausted or closed.
+    with_answers adds normalized_answers; by_region groups rows by region
+    first, keeping leaderboard order within each region.
+    """
+    ph = get_ph()
+    columns = LEADERBOARD_COLUMNS + (", s.normalized_answers" if with_answers else "")
+    order = ("u.region, " if by_region else "") + LEADERBOARD_ORDER
+    sql = f'''
+        SELECT {columns}
         FROM submissions s
         JOIN users u ON s.user_id = u.id
         WHERE s.test_id = {ph}
-        ORDER BY s.percent DESC, s.correct_count DESC, s.time_taken_seconds ASC
-    ''', (test_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+        ORDER BY {order}
+    '''
+    with get_connection() as conn:
+        if DATABASE_URL:
+            c = conn.cursor(name=f"submissions_{test_id}_{next(_cursor_ids)}", cursor_factory=RealDictCursor)
+            c.itersize = chunk_size
+        else:
+            c = conn.cursor()
+        try:
+            c.execute(sql, (test_id,))
+            while True:
+                rows = c.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            c.close()
+
+@timed_query
+def get_top_submissions(test_id, limit=3):
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT {LEADERBOARD_COLUMNS}
+            FROM submissions s
+            JOIN users u ON s.user_id = u.id
+            WHERE s.test_id = {ph}
+            ORDER BY {LEADERBOARD_ORDER}
+            LIMIT {ph}
+        ''', (test_id, limit))
+        return c.fetchall()
+
+@timed_query
+def get_submission_count(test_id):
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT COUNT(*) AS c FROM submissions WHERE test_id = {ph}', (test_id,))
+        return c.fetchone()['c']
+
+# --- Broadcast Queries ---
+@_write
+@timed_query
+def create_broadcast(admin_chat_id, from_chat_id, message_id, status_message_id, total):
+    ph = get_ph()
+    sql = f'''
+        INSERT INTO broadcasts (admin_chat_id, from_chat_id, message_id, status_message_id, total, status)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, 'running')
+    '''
+    params = (admin_chat_id, from_chat_id, message_id, status_message_id, total)
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        if DATABASE_URL:
+            sql += " RETURNING id"
+            c.execute(sql, params)
+            broadcast_id = c.fetchone()['id']
+        else:
+            c.execute(sql, params)
+            broadcast_id = c.lastrowid
+        conn.commit()
+    return broadcast_id
+
+@timed_query
+def get_broadcast(broadcast_id):
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT * FROM broadcasts WHERE id = {ph}', (broadcast_id,))
+        return c.fetchone()
+
+@timed_query
+def get_running_broadcasts():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return c.fetchall()
+
+@timed_query
+def get_broadcast_recipients(after_user_id, limit):
+    """Next page of recipients in users.id order, for keyset-paginated sending."""
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT id, tg_user_id FROM users
+            WHERE id > {ph}
+            ORDER BY id
+            LIMIT {ph}
+        ''', (after_user_id, limit))
+        return c.fetchall()
+
+@_write
+@timed_query
+def update_broadcast_progress(broadcast_id, last_user_id, sent_count, failed_count):
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            UPDATE broadcasts
+            SET last_user_id = {ph}, sent_count = {ph}, failed_count = {ph}
+            WHERE id = {ph}
+        ''', (last_user_id, sent_count, failed_count, broadcast_id))
+        conn.commit()
+
+@_write
+@timed_query
+def finish_broadcast(broadcast_id, finished_at):
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"UPDATE broadcasts SET status = 'done', finished_at = {ph} WHERE id = {ph}", (finished_at, broadcast_id))
+        conn.commit()
+
+# --- Bot Persistence (services.persistence) ---
+@timed_query
+def load_user_data(user_id):
+    """The stored user_data JSON of one Telegram user, or None."""
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT data FROM user_data WHERE user_id = {ph}", (user_id,))
+        row = c.fetchone()
+        return row['data'] if row else None
+
+@timed_query
+def load_conversations(name):
+    """[(conv_key JSON, state JSON)] of one ConversationHandler's open conversations."""
+    ph = get_ph()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT conv_key, state FROM conversation_states WHERE name = {ph}", (name,))
+        return [(r['conv_key'], r['state']) for r in c.fetchall()]
+
+@_write
+@timed_query
+def save_persistence(user_data, conversations):
+    """
+    Writes one batch of bot state in a single transaction.
+    user_data: {user_id: JSON}, conversations: {(name, conv_key): state JSON};
+    a None value deletes the row.
+    """
+    ph = get_ph()
+    upsert_users = [(user_id, data) for user_id, data in user_data.items() if data is not None]
+    delete_users = [(user_id,) for user_id, data in user_data.items() if data is None]
+    upsert_states = [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+    delete_states = [(name, key) for (name, key), state in conversations.items() if state is None]
+    with get_connection() as conn:
+        c = conn.cursor()
+        if upsert_users:
+            sql = '''
+                INSERT INTO user_data (user_id, data) VALUES {values}
+                ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+            '''
+            if DATABASE_URL:
+                execute_values(c, sql.format(values="%s"), upsert_users, page_size=len(upsert_users))
+            else:
+                c.executemany(sql.format(values=f"({ph}, {ph})"), upsert_users)
+        if upsert_states:
+            sql = '''
+                INSERT INTO conversation_states (name, conv_key, state) VALUES {values}
+                ON CONFLICT (name, conv_key) DO UPDATE SET state = excluded.state, updated_at = CURRENT_TIMESTAMP
+            '''
+            if DATABASE_URL:
+                execute_values(c, sql.format(values="%s"), upsert_states, page_size=len(upsert_states))
+            else:
+                c.executemany(sql.format(values=f"({ph}, {ph}, {ph})"), upsert_states)
+        if delete_users:
+            c.executemany(f"DELETE FROM user_data WHERE user_id = {ph}", delete_users)
+        if delete_states:
+            c.executemany(f"DELETE FROM conversation_states WHERE name = {ph} AND conv_key = {ph}", delete_states)
+        conn.commit()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import config
+import db.async_queries as db
+from db.cache import get_key_version
+from services.grader import grade_with_plan
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionWriter:
+    """
+    Group-commits graded submissions.
+
+    Handlers call submit() and await the outcome. Queued rows are flushed
+    together, when `max_batch` are waiting or `max_delay` seconds after the
+    first one arrived, as one transaction with one commit. So an exam-start
+    burst costs a few commits instead of one per student. The future resolves
+    only after the commit, with the same (inserted, row) result as
+    db.insert_submission. If a batch fails, its rows are retried one at a
+    time, so only the submissions that fail on their own get an error.
+
+    A submission graded before its test's answer key changed (see
+    db.cache.get_key_version) is re-graded against the new key before it
+    is written, so a regrade can't miss it.
+    """
+
+    def __init__(self, max_batch=200, max_delay=0.005):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = None
+        self._task = None
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flushes everything already queued, then stops the writer."""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def wait_flushed(self):
+        """Returns once the batch being written right now (if any) is committed."""
+        await self._idle.wait()
+
+    async def submit(self, test_id, user_id, raw, normalized, correct, wrong, percent, started_at, time_taken,
+                     key_version=None):
+        """key_version: get_key_version(test_id) as read before grading."""
+        params = (test_id, user_id, raw, normalized, correct, wrong, percent, started_at, time_taken)
+        if not self.running:
+            # Not started (scripts, tests): write directly
+            [params] = await self._regrade_stale([(params, key_version)])
+            return await db.insert_submission(*params)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((params, key_version, future))
+        return await future
+
+    async def _regrade_stale(self, rows):
+        # rows: [(params, key_version)] -> params, graded against the current key
+        result = []
+        for params, key_version in rows:
+            test_id = params[0]
+            if key_version is not None and key_version != get_key_version(test_id):
+                test = await db.get_test_meta(test_id)
+                if test is not None and test.answer_key:
+                    correct, wrong, percent = grade_with_plan(params[3], test.answer_key, test.plan)
+                    params = params[:4] + (correct, wrong, percent) + params[7:]
+            result.append(params)
+        return result
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        futures = [future for _, _, future in batch]
+        self._idle.clear()
+        try:
+            rows = await self._regrade_stale([(params, key_version) for params, key_version, _ in batch])
+            try:
+                results = await db.insert_submissions_batch(rows)
+            except Exception as e:
+                # One bad row shouldn't fail everyone batched with it
+                logger.error(f"Failed to write batch of {len(batch)} submissions, retrying one by one: {e}")
+                results = [await self._insert_one(params) for params in rows]
+        except Exception as e:
+            logger.error(f"Failed to write batch of {len(batch)} submissions: {e}")
+            results = [e] * len(batch)
+        finally:
+            self._idle.set()
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _insert_one(self, params):
+        # In batch order, so the first of two rows for the same user still wins
+        try:
+            return await db.insert_submission(*params)
+        except Exception as e:
+            logger.error(f"Failed to write submission of user {params[1]} for test #{params[0]}: {e}")
+            return e
+
+submission_writer = SubmissionWriter(
+    max_batch=config.SUBMISSION_BATCH_SIZE,
+    max_delay=config.SUBMISSION_BATCH_DELAY_MS / 1000.0,
+)
@@ -24,56 +24,52 @@ from bot_handlers.admin import (
     start_create_test, receive_title, receive_questions, receive_duration, confirm_creation,
     manage_tests, view_test, start_test_callback, end_test_callback,
     set_key_start, receive_answer_key,
-    admin_leaderboard_menu, send_leaderboard_callback,
+    admin_leaderboard_menu, send_leaderboard_callback, item_analysis_callback,
     start_broadcast, send_broadcast, admin_stats_callback
 )
-from bot_handlers.user import start, register_name, register_region, handle_submission, handle_invalid_message, handle_static_menu
+from bot_handlers.user import start, check_subscription_callback, register_name, register_region, handle_submission, handle_invalid_message, handle_static_menu
 from bot_handlers.common import cancel, ASK_TITLE, ASK_QUESTIONS, ASK_DURATION, ASK_CONFIRM, ASK_ANSWER_KEY, REGISTER_NAME, REGISTER_REGION, ASK_BROADCAST_MSG
-from scheduler.jobs import check_active_tests
+from scheduler.jobs import check_active_tests, schedule_test_jobs
 from db.init_db import init_db
+import db.async_queries as async_db
+from db.writer import submission_writer
+from services.broadcast import resume_campaigns, stop_campaigns
+from services.ranking import load_active_indexes
+from services.update_processor import update_processor
+from services.persistence import persistence
+from services import metrics
+from telegram.request import HTTPXRequest
 
 # Initialize DB on startup
 init_db()
 
-def main():
-    print("Bot is starting...")
-    if not config.BOT_TOKEN:
-        print("Error: BOT_TOKEN not found in .env")
-        return
+# Post-init hook to notify admins
+async def on_startup(app: Application):
+    await submission_writer.start()
+    await resume_campaigns(app.bot)
+    await load_active_indexes()
+    await schedule_test_jobs(app.job_queue)
+    await metrics.start_server()
+    for admin_id in config.ADMIN_USER_IDS:
+        try:
+            await app.bot.send_message(chat_id=admin_id, text="🤖 <b>Bot qayta ishga tushdi!</b>\n\nYangilanishlar muvaffaqiyatli yuklandi.", parse_mode='HTML')
+        except Exception as e:
+            logging.error(f"Failed to notify admin {admin_id}: {e}")
 
-    # Fix for APScheduler/PTB on Python 3.12+ where no loop exists yet
-    import asyncio
-    try:
-        asyncio.get_running_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    
-    # Use custom JobQueue to enforce our pytz timezone
-    class FixedJobQueue(JobQueue):
-        @property
-        def scheduler_configuration(self):
-            conf = super().scheduler_configuration
-            conf['timezone'] = pytz.timezone(config.TIMEZONE)
-            return conf
+async def on_shutdown(app: Application):
+    # Pause broadcasts (resumed on next start), close the metrics endpoint,
+    # flush queued submissions, finish in-flight queries, close pooled connections
+    await stop_campaigns()
+    await metrics.stop_server()
+    await submission_writer.stop()
+    async_db.shutdown()
 
-    job_queue = FixedJobQueue()
-    # Post-init hook to notify admins
-    async def on_startup(app: Application):
-        for admin_id in config.ADMIN_USER_IDS:
-            try:
-                await app.bot.send_message(chat_id=admin_id, text="🤖 <b>Bot qayta ishga tushdi!</b>\n\nYangilanishlar muvaffaqiyatli yuklandi.", parse_mode='HTML')
-            except Exception as e:
-                logging.error(f"Failed to notify admin {admin_id}: {e}")
 
-    application = (
-        ApplicationBuilder()
-        .token(config.BOT_TOKEN)
-        .job_queue(job_queue)
-        .post_init(on_startup)
-        .build()
-    )
-    
+def register_handlers(application: Application):
+    """Adds every conversation and handler to the application (also used by the load test)."""
+    # Conversation states survive restarts when the application has a persistence
+    persistent = application.persistence is not None
+
     # --- Admin Conversations ---
     
     # Create Test Wizard
@@ -85,7 +81,9 @@ def main():
             ASK_DURATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_duration)],
             ASK_CONFIRM: [CallbackQueryHandler(confirm_creation, pattern="^create_.*")]
         },
-        fallbacks=[CommandHandler("cancel", cancel), CallbackQueryHandler(cancel, pattern="^create_cancel$")]
+        fallbacks=[CommandHandler("cancel", cancel), CallbackQueryHandler(cancel, pattern="^create_cancel$")],
+        name="create_test",
+        persistent=persistent
     )
     
     # Set Answer Key Wizard
@@ -94,7 +92,9 @@ def main():
         states={
             ASK_ANSWER_KEY: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_answer_key)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="set_key",
+        persistent=persistent
     )
     
     # Broadcast Wizard
@@ -103,17 +103,24 @@ def main():
         states={
             ASK_BROADCAST_MSG: [MessageHandler(filters.ALL & ~filters.COMMAND, send_broadcast)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="broadcast",
+        persistent=persistent
     )
     
     # User Registration
     register_conv = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[
+            CommandHandler("start", start),
+            CallbackQueryHandler(check_subscription_callback, pattern="^check_subscription$")
+        ],
         states={
             REGISTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_name)],
             REGISTER_REGION: [MessageHandler(filters.TEXT & ~filters.COMMAND, register_region)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="register",
+        persistent=persistent
     )
 
     # --- Handlers ---
@@ -128,6 +135,7 @@ def main():
     application.add_handler(CallbackQueryHandler(end_test_callback, pattern="^end_test_"))
     application.add_handler(CallbackQueryHandler(admin_leaderboard_menu, pattern="^admin_leaderboard_menu$"))
     application.add_handler(CallbackQueryHandler(send_leaderboard_callback, pattern="^get_leaderboard_"))
+    application.add_handler(CallbackQueryHandler(item_analysis_callback, pattern="^item_analysis_"))
     application.add_handler(CallbackQueryHandler(admin_stats_callback, pattern="^admin_stats$"))
     
     # Conversations
@@ -145,13 +153,78 @@ def main():
     # Catch-all for invalid messages (must be last)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_invalid_message))
 
+
+def webhook_options(**overrides):
+    """Arguments for run_webhook / Updater.start_webhook (also used by the load test)."""
+    options = dict(
+        listen=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        url_path=config.WEBHOOK_PATH,
+        webhook_url=f"{config.WEBHOOK_URL}/{config.WEBHOOK_PATH}",
+        secret_token=config.WEBHOOK_SECRET,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+    )
+    options.update(overrides)
+    return options
+
+
+def main():
+    print("Bot is starting...")
+    if not config.BOT_TOKEN:
+        print("Error: BOT_TOKEN not found in .env")
+        return
+
+    # Fix for APScheduler/PTB on Python 3.12+ where no loop exists yet
+    import asyncio
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    
+    # Use custom JobQueue to enforce our pytz timezone
+    class FixedJobQueue(JobQueue):
+        @property
+        def scheduler_configuration(self):
+            conf = super().scheduler_configuration
+            conf['timezone'] = pytz.timezone(config.TIMEZONE)
+            return conf
+
+    job_queue = FixedJobQueue()
+    builder = ApplicationBuilder()
+    if metrics.ENABLED:
+        # Same pool size ApplicationBuilder uses by default
+        builder = builder.request(metrics.TimedRequest(HTTPXRequest(connection_pool_size=256)))
+    application = (
+        builder
+        .token(config.BOT_TOKEN)
+        .job_queue(job_queue)
+        .concurrent_updates(update_processor)
+        .persistence(persistence)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    register_handlers(application)
+    metrics.instrument_handlers(application)
+
     # --- Scheduler ---
     job_queue = application.job_queue
-    # Run every 60 seconds
-    job_queue.run_repeating(check_active_tests, interval=60, first=10)
+    # Per-test jobs do the real work; this sweep is only a safety net
+    job_queue.run_repeating(check_active_tests, interval=config.TEST_RECONCILE_INTERVAL, first=config.TEST_RECONCILE_INTERVAL)
 
-    print("Bot is running...")
-    application.run_polling()
+    if config.WEBHOOK_URL:
+        if not config.WEBHOOK_SECRET:
+            print("Error: WEBHOOK_SECRET must be set when WEBHOOK_URL is")
+            return
+        # On SIGTERM the server stops accepting requests first, then every
+        # update already queued is handled before on_shutdown runs.
+        print(f"Bot is running (webhook on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT})...")
+        application.run_webhook(**webhook_options())
+    else:
+        print("Bot is running...")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
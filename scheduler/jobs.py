@@ -1,59 +1,160 @@
 from telegram.ext import ContextTypes
-import db.queries as db
-from services.exporter import generate_leaderboard_html
-from io import BytesIO
-from datetime import datetime
+import db.async_queries as db
+from services.metrics import timed_job
+from services.leaderboard import send_leaderboard
+from services.ranking import load_index, drop_index
+from datetime import datetime, timedelta
 import logging
 import config
 
 logger = logging.getLogger(__name__)
 
-async def check_active_tests(context: ContextTypes.DEFAULT_TYPE):
-    """
-    Periodic job to check for expired tests.
-    """
-    now = datetime.now()
-    expired_tests = db.get_active_tests_needing_end(now)
-    
-    for test in expired_tests:
-        test_id = test['id']
-        logger.info(f"Auto-ending expired test #{test_id}")
-        
-        # End it
-        db.end_test_db(test_id)
-        
-        # Generate Leaderboard
-        submissions = db.get_test_submissions(test_id)
-        if not submissions:
-            continue
-            
-        html_content = generate_leaderboard_html(test['title'], submissions)
-        file_obj = BytesIO(html_content.encode('utf-8'))
-        file_obj.name = f"leaderboard_test_{test_id}_{now.strftime('%H%M')}.html"
-        
-        # Send to valid admins
-        # We need a chat_id to send to. Usually we send to ADMIN_USER_IDS.
-        # But send_document requires a chat_id (which is user_id in private chat).
-        # We'll try to send to all admins defined in config.
+# Each active test has a one-shot job firing at its end_at, and each draft
+# with a start_at in the future one firing then. Jobs live only in memory:
+# schedule_test_jobs() rebuilds them from the database at startup, and
+# check_active_tests() is a slow sweep that catches anything they missed.
+
+def _job_name(kind, test_id):
+    return f"{kind}_test_{test_id}"
+
+def _as_datetime(value):
+    # SQLite hands timestamps back as ISO strings
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+def _delay(when):
+    # Times in the DB are naive local datetimes; a delay in seconds sidesteps
+    # the JobQueue's own timezone handling.
+    return max(0.0, (_as_datetime(when) - datetime.now()).total_seconds())
+
+def _schedule(job_queue, kind, callback, test_id, when):
+    if job_queue is None:
+        return
+    name = _job_name(kind, test_id)
+    for job in job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    # No misfire grace limit: a job that fires late (busy loop) still runs
+    job_queue.run_once(callback, _delay(when), data=test_id, name=name,
+                       job_kwargs={'misfire_grace_time': None})
+
+def schedule_test_end(job_queue, test_id, end_at):
+    _schedule(job_queue, "end", end_test_job, test_id, end_at)
+
+def schedule_test_start(job_queue, test_id, start_at):
+    _schedule(job_queue, "start", start_test_job, test_id, start_at)
+
+def cancel_test_jobs(job_queue, test_id):
+    if job_queue is None:
+        return
+    for kind in ("start", "end"):
+        for job in job_queue.get_jobs_by_name(_job_name(kind, test_id)):
+            job.schedule_removal()
+
+def _has_job(job_queue, kind, test_id):
+    return bool(job_queue.get_jobs_by_name(_job_name(kind, test_id)))
+
+
+async def schedule_test_jobs(job_queue):
+    """Called at startup: one job per active test's end and per scheduled start."""
+    active = await db.get_active_tests()
+    for test in active:
+        schedule_test_end(job_queue, test['id'], test['end_at'])
+    scheduled = await db.get_scheduled_tests()
+    for test in scheduled:
+        schedule_test_start(job_queue, test['id'], test['start_at'])
+    logger.info(f"Scheduled {len(active)} test end(s) and {len(scheduled)} test start(s)")
+
+
+async def activate_test(job_queue, test):
+    """Starts a scheduled draft at its start_at and schedules its end."""
+    start_at = _as_datetime(test['start_at'])
+    end_at = start_at + timedelta(hours=test['duration_hours'])
+    logger.info(f"Starting scheduled test #{test['id']}")
+    await db.start_test_db(test['id'], start_at, end_at)
+    await load_index(test['id'])
+    schedule_test_end(job_queue, test['id'], end_at)
+
+@timed_job
+async def start_test_job(context: ContextTypes.DEFAULT_TYPE):
+    test = await db.get_test(context.job.data)
+    # The admin may have started it by hand or changed it meanwhile
+    if not test or test['status'] != 'draft' or not test['start_at'] or not test['answer_key']:
+        return
+    if _as_datetime(test['start_at']) > datetime.now():
+        schedule_test_start(context.job_queue, test['id'], test['start_at'])
+        return
+    await activate_test(context.job_queue, test)
+
+
+async def finish_test(bot, test):
+    """Ends an expired test and sends its leaderboard to the admins."""
+    test_id = test['id']
+    logger.info(f"Auto-ending expired test #{test_id}")
+
+    # End it
+    await db.end_test_db(test_id)
+    drop_index(test_id)
+
+    # Generate Leaderboard
+    top = await db.get_top_submissions(test_id, limit=3)
+    if not top:
+        return
+
+    def make_caption(count):
         message = (
             f"🏁 <b>Test #{test_id} has ended!</b>\n"
             f"Title: {test['title']}\n"
-            f"Total Submissions: {len(submissions)}\n\n"
+            f"Total Submissions: {count}\n\n"
             "Top 3:\n"
         )
-        
-        for i, sub in enumerate(submissions[:3], 1):
-             message += f"{i}. {sub['full_name']} - {sub['percent']}%\n"
-             
-        for admin_id in config.ADMIN_USER_IDS:
-            try:
-                # Reset stream position for each send
-                file_obj.seek(0)
-                await context.bot.send_document(
-                    chat_id=admin_id,
-                    document=file_obj,
-                    caption=message,
-                    parse_mode='HTML'
-                )
-            except Exception as e:
-                logger.error(f"Failed to send leaderboard to admin {admin_id}: {e}")
+        for i, sub in enumerate(top, 1):
+            message += f"{i}. {sub['full_name']} - {sub['percent']}%\n"
+        return message
+
+    # Send to valid admins
+    # We need a chat_id to send to. Usually we send to ADMIN_USER_IDS.
+    # But send_document requires a chat_id (which is user_id in private chat).
+    # We'll try to send to all admins defined in config.
+    # Only the first send uploads; the rest reuse its Telegram file_id. The
+    # default filename carries the results version, so it stays accurate.
+    for admin_id in config.ADMIN_USER_IDS:
+        try:
+            await send_leaderboard(bot, admin_id, test, make_caption)
+        except Exception as e:
+            logger.error(f"Failed to send leaderboard to admin {admin_id}: {e}")
+
+@timed_job
+async def end_test_job(context: ContextTypes.DEFAULT_TYPE):
+    test = await db.get_test(context.job.data)
+    # Ended by hand already, or restarted with a new end_at
+    if not test or test['status'] != 'active':
+        return
+    if _as_datetime(test['end_at']) > datetime.now():
+        schedule_test_end(context.job_queue, test['id'], test['end_at'])
+        return
+    await finish_test(context.bot, test)
+
+
+@timed_job
+async def check_active_tests(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Safety net behind the per-test jobs, run every TEST_RECONCILE_INTERVAL:
+    ends anything overdue, starts anything due, and reschedules tests that
+    lost their job.
+    """
+    now = datetime.now()
+    for test in await db.get_active_tests_needing_end(now):
+        logger.warning(f"Test #{test['id']} was still active past its end_at")
+        await finish_test(context.bot, test)
+
+    for test in await db.get_scheduled_tests():
+        if _as_datetime(test['start_at']) <= now:
+            if test['answer_key']:
+                await activate_test(context.job_queue, test)
+        elif not _has_job(context.job_queue, "start", test['id']):
+            schedule_test_start(context.job_queue, test['id'], test['start_at'])
+
+    for test in await db.get_active_tests():
+        if not _has_job(context.job_queue, "end", test['id']):
+            schedule_test_end(context.job_queue, test['id'], test['end_at'])
@@ -0,0 +1,155 @@
+import logging
+import math
+import string
+from collections import namedtuple
+from itertools import islice
+import numpy as np
+from db.cache import get_results_version
+from db.queries import iter_test_submissions, get_submission_count
+from services.grader import encode_answers, compile_plan, plan_columns, parse_plan
+
+logger = logging.getLogger(__name__)
+
+# Share of participants in the upper and lower groups for the discrimination index
+GROUP_FRACTION = 0.27
+# Submissions encoded and counted per vectorized step
+CHUNK_SIZE = 2000
+
+LETTERS = string.ascii_uppercase
+# Column of the count matrix for anything that isn't A-Z (blank, other symbols)
+OTHER = len(LETTERS)
+
+# Per-question statistics of one test, computed from its stored submissions.
+# counts is a (num_questions, 27) matrix: how many chose A..Z, or something else.
+# Correct means accepted by the scoring plan, if the test has one.
+# correct_rate is percent correct per question; discrimination is
+# (correct in upper group - correct in lower group) / group_size, from -1 to 1.
+ItemAnalysis = namedtuple("ItemAnalysis", [
+    "version", "answer_key", "scoring_plan", "participants", "group_size",
+    "counts", "correct_rate", "discrimination",
+])
+
+_analyses = {}  # test_id -> ItemAnalysis
+
+
+def _option_columns(matrix):
+    """Maps encoded answer letters to count matrix columns (A=0 .. Z=25, else OTHER)."""
+    columns = matrix.astype(np.int64) - ord('A')
+    columns[(columns < 0) | (columns >= OTHER)] = OTHER
+    return columns
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def analyze_submissions(answer_key, submissions, participants, plan=None):
+    """
+    Builds the item analysis from answer strings in rank order (best first)
+    in one pass. participants is the expected row count, used to size the
+    upper and lower groups before the rows are read; extra or missing rows
+    only shift the group boundary.
+    """
+    if plan is not None and plan.simple:
+        plan = None
+    width = len(answer_key)
+    key = encode_answers([answer_key], width)[0]
+    group_size = max(1, math.ceil(participants * GROUP_FRACTION)) if participants else 0
+    lower_start = participants - group_size
+
+    counts = np.zeros(width * (OTHER + 1), dtype=np.int64)
+    correct = np.zeros(width, dtype=np.int64)
+    upper = np.zeros(width, dtype=np.int64)
+    lower = np.zeros(width, dtype=np.int64)
+    offsets = np.arange(width, dtype=np.int64) * (OTHER + 1)
+
+    seen = 0
+    for chunk in _chunks(submissions, CHUNK_SIZE):
+        matrix = encode_answers(chunk, width)
+        chunk_key = key
+        if matrix.dtype != key.dtype:
+            matrix, chunk_key = matrix.astype(np.uint32), key.astype(np.uint32)
+        # One bincount over (question, option) cells fills the whole chunk
+        cells = (_option_columns(matrix) + offsets).ravel()
+        counts += np.bincount(cells, minlength=counts.size)
+
+        if plan is None:
+            hits = matrix == chunk_key
+        else:
+            hits = plan.accepted[np.arange(width), plan_columns(matrix)]
+        correct += hits.sum(axis=0)
+        positions = np.arange(seen, seen + len(chunk))
+        upper += hits[positions < group_size].sum(axis=0)
+        lower += hits[positions >= lower_start].sum(axis=0)
+        seen += len(chunk)
+
+    counts = counts.reshape(width, OTHER + 1)
+    # Only one value per question: round() them like the rest of the bot does
+    correct_rate = np.array([round(c * 100.0 / seen, 1) if seen else 0.0 for c in correct.tolist()])
+    discrimination = np.array([
+        round(d / group_size, 2) if group_size else 0.0 for d in (upper - lower).tolist()
+    ])
+    spec = plan.spec if plan is not None else None
+    return ItemAnalysis(None, answer_key, spec, seen, group_size, counts, correct_rate, discrimination)
+
+
+def compute_item_analysis(test):
+    """Blocking: item analysis of a test, reused until its results or key change."""
+    test_id = test['id']
+    answer_key = test['answer_key'] or ""
+    spec = test['scoring_plan']
+    cached = _analyses.get(test_id)
+    version = get_results_version(test_id)
+    if (cached is not None and cached.version == version
+            and cached.answer_key == answer_key and cached.scoring_plan == spec):
+        return cached
+
+    participants = get_submission_count(test_id)
+    rows = iter_test_submissions(test_id, with_answers=True)
+    plan = compile_plan(answer_key, spec) if spec else None
+    analysis = analyze_submissions(
+        answer_key, (r['normalized_answers'] or "" for r in rows), participants, plan
+    )
+    # Keyed to the version read before the pass, so a submission that lands
+    # meanwhile makes this entry stale rather than wrong
+    analysis = analysis._replace(version=version)
+    _analyses[test_id] = analysis
+    logger.info(f"Item analysis for test #{test_id} computed ({analysis.participants} submissions)")
+    return analysis
+
+
+def option_letters(analysis):
+    """Letters worth showing: A up to the last one in the key or chosen by anyone."""
+    used = [i for i in range(OTHER) if analysis.counts[:, i].any()]
+    used += [LETTERS.index(c) for c in analysis.answer_key if c in LETTERS]
+    last = max(used, default=-1)
+    return LETTERS[:last + 1]
+
+
+def item_rows(analysis):
+    """
+    One dict per question for reports:
+    question, key, correct_rate, discrimination, options ({letter: count}), other.
+    """
+    letters = option_letters(analysis)
+    keys = list(analysis.answer_key)
+    if analysis.scoring_plan:
+        # Show every accepted letter, e.g. "B/C"
+        keys = ["/".join(accepted) for accepted, _, _ in parse_plan(analysis.scoring_plan)]
+    rows = []
+    for q, key_letter in enumerate(keys):
+        counts = analysis.counts[q]
+        rows.append({
+            'question': q + 1,
+            'key': key_letter,
+            'correct_rate': float(analysis.correct_rate[q]),
+            'discrimination': float(analysis.discrimination[q]),
+            'options': {letter: int(counts[i]) for i, letter in enumerate(letters)},
+            'other': int(counts[OTHER]),
+        })
+    return rows
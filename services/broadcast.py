@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError, TelegramError
+import db.async_queries as db
+import config
+
+logger = logging.getLogger(__name__)
+
+MAX_SEND_ATTEMPTS = 5
+
+# campaign id -> running asyncio.Task, so a campaign never runs twice
+_running = {}
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every send of every campaign, so the bot as a
+    whole stays under Telegram's global limit. A 429 pauses all senders,
+    not just the one that hit it.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+_limiter = None
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(config.BROADCAST_RATE)
+    return _limiter
+
+
+def _retry_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class BroadcastCampaign:
+    """
+    Sends one persisted broadcast to every user, in users.id order.
+
+    Recipients are fetched a page at a time and sent with bounded
+    concurrency under the shared rate limiter. After each page the cursor
+    and counters are saved, so a restart resumes from the last finished
+    page. At most one page may be sent twice after a crash.
+    """
+
+    def __init__(self, bot, campaign):
+        self.bot = bot
+        self.id = campaign['id']
+        self.admin_chat_id = campaign['admin_chat_id']
+        self.from_chat_id = campaign['from_chat_id']
+        self.message_id = campaign['message_id']
+        self.status_message_id = campaign['status_message_id']
+        self.total = campaign['total'] or 0
+        self.last_user_id = campaign['last_user_id'] or 0
+        self.sent = campaign['sent_count'] or 0
+        self.failed = campaign['failed_count'] or 0
+        self.limiter = get_limiter()
+        self._semaphore = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+        self._status_text = None
+        self._status_edited_at = 0.0
+
+    async def run(self):
+        logger.info(f"Broadcast #{self.id}: starting after user id {self.last_user_id}")
+        while True:
+            recipients = await db.get_broadcast_recipients(self.last_user_id, config.BROADCAST_PAGE_SIZE)
+            if not recipients:
+                break
+            results = await asyncio.gather(*(self._send(r['tg_user_id']) for r in recipients))
+            delivered = sum(results)
+            self.sent += delivered
+            self.failed += len(results) - delivered
+            self.last_user_id = recipients[-1]['id']
+            await db.update_broadcast_progress(self.id, self.last_user_id, self.sent, self.failed)
+            await self._update_status()
+
+        await db.finish_broadcast(self.id, datetime.now())
+        await self._update_status(final=True)
+        logger.info(f"Broadcast #{self.id}: done, sent {self.sent}, failed {self.failed}")
+
+    async def _send(self, chat_id):
+        async with self._semaphore:
+            for attempt in range(MAX_SEND_ATTEMPTS):
+                await self.limiter.acquire()
+                try:
+                    await self.bot.copy_message(
+                        chat_id=chat_id,
+                        from_chat_id=self.from_chat_id,
+                        message_id=self.message_id
+                    )
+                    return True
+                except RetryAfter as e:
+                    logger.warning(f"Broadcast #{self.id}: flood limit, pausing {e.retry_after}s")
+                    self.limiter.pause(_retry_seconds(e))
+                except (Forbidden, BadRequest):
+                    # Blocked the bot, deleted account, chat not found: retrying won't help
+                    return False
+                except NetworkError as e:
+                    logger.warning(f"Broadcast #{self.id}: network error for {chat_id}: {e}")
+                    await asyncio.sleep(2 ** attempt)
+                except TelegramError as e:
+                    # ChatMigrated and the like: count it as failed, keep the campaign going
+                    logger.warning(f"Broadcast #{self.id}: {type(e).__name__} for {chat_id}: {e}")
+                    return False
+                except Exception as e:
+                    logger.error(f"Broadcast #{self.id}: unexpected error for {chat_id}: {e}")
+                    return False
+            return False
+
+    async def _update_status(self, final=False):
+        if not self.status_message_id:
+            return
+        if final:
+            text = (
+                f"✅ Xabar yuborildi!\n\n"
+                f"Muvaffaqiyatli: {self.sent}\n"
+                f"Xatolik: {self.failed}"
+            )
+        else:
+            text = (
+                f"Yuborilmoqda... Jami: {self.total}\n\n"
+                f"Muvaffaqiyatli: {self.sent}\n"
+                f"Xatolik: {self.failed}"
+            )
+        # Throttled and skipped when nothing changed: edits share the rate budget
+        now = time.monotonic()
+        if text == self._status_text:
+            return
+        if not final and now - self._status_edited_at < config.BROADCAST_STATUS_INTERVAL:
+            return
+        await self.limiter.acquire()
+        try:
+            await self.bot.edit_message_text(chat_id=self.admin_chat_id, message_id=self.status_message_id, text=text)
+            self._status_text = text
+            self._status_edited_at = now
+        except RetryAfter as e:
+            self.limiter.pause(_retry_seconds(e))
+        except Exception as e:
+            logger.warning(f"Broadcast #{self.id}: failed to update status message: {e}")
+
+
+async def _run_campaign(bot, campaign):
+    try:
+        await BroadcastCampaign(bot, campaign).run()
+    except asyncio.CancelledError:
+        logger.info(f"Broadcast #{campaign['id']}: stopped, will resume on restart")
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast #{campaign['id']} failed: {e}")
+    finally:
+        _running.pop(campaign['id'], None)
+
+async def start_campaign(bot, campaign_id):
+    if campaign_id in _running:
+        return
+    campaign = await db.get_broadcast(campaign_id)
+    if campaign is None or campaign['status'] != 'running':
+        return
+    _running[campaign_id] = asyncio.create_task(_run_campaign(bot, campaign))
+
+async def resume_campaigns(bot):
+    """Restarts campaigns that were still running when the bot stopped."""
+    for campaign in await db.get_running_broadcasts():
+        if campaign['id'] not in _running:
+            logger.info(f"Resuming broadcast #{campaign['id']}")
+            _running[campaign['id']] = asyncio.create_task(_run_campaign(bot, campaign))
+
+async def stop_campaigns():
+    """Cancels running campaigns; their saved progress is resumed on the next start."""
+    tasks = list(_running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
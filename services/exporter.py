@@ -1,19 +1,25 @@
 from datetime import timedelta
+from html import escape
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+# Rows are rendered into a list and written out in chunks of this size
+ROWS_PER_CHUNK = 500
+# Exports smaller than this stay in memory, larger ones spill to a temp file
+SPOOL_MAX_SIZE = 1024 * 1024
 
 def format_time_taken(seconds):
     return str(timedelta(seconds=seconds))
 
-def generate_leaderboard_html(test_title, submissions):
-    """
-    Generates a simple HTML table for the leaderboard.
-    submissions: list of dict-like objects (from db query)
-    """
-    html = f"""
+HTML_HEAD = """
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="UTF-8">
-        <title>Leaderboard: {test_title}</title>
+        <title>Leaderboard: {title}</title>
         <style>
             body {{ font-family: sans-serif; }}
             table {{ border-collapse: collapse; width: 100%; }}
@@ -23,7 +29,7 @@ def generate_leaderboard_html(test_title, submissions):
         </style>
     </head>
     <body>
-        <h2>Leaderboard: {test_title}</h2>
+        <h2>Leaderboard: {title}</h2>
         <table>
             <thead>
                 <tr>
@@ -39,29 +45,200 @@ def generate_leaderboard_html(test_title, submissions):
             </thead>
             <tbody>
     """
-    
-    for idx, sub in enumerate(submissions, 1):
-        # sub keys: full_name, username, correct_count, wrong_count, percent, time_taken_seconds, submitted_at
-        user_display = f"@{sub['username']}" if sub['username'] else "N/A"
-        time_display = format_time_taken(sub['time_taken_seconds'] or 0)
-        
-        html += f"""
+
+HTML_ROW = """
             <tr>
-                <td>{idx}</td>
-                <td>{sub['full_name']}</td>
-                <td>{user_display}</td>
-                <td>{sub['correct_count']}</td>
-                <td>{sub['wrong_count']}</td>
-                <td>{sub['percent']}%</td>
-                <td>{time_display}</td>
-                <td>{sub['submitted_at']}</td>
+                <td>{rank}</td>
+                <td>{name}</td>
+                <td>{user}</td>
+                <td>{correct}</td>
+                <td>{wrong}</td>
+                <td>{percent}%</td>
+                <td>{time}</td>
+                <td>{submitted_at}</td>
             </tr>
         """
-        
-    html += """
+
+HTML_TABLE_END = """
             </tbody>
         </table>
+    """
+
+HTML_TAIL = """
     </body>
     </html>
     """
-    return html
+
+HTML_ITEMS_HEAD = """
+        <h2>Savollar tahlili</h2>
+        <table>
+            <thead>
+                <tr>
+                    <th>Question</th>
+                    <th>Key</th>
+                    <th>Correct</th>
+                    <th>Discrimination</th>
+                    {option_headers}
+                </tr>
+            </thead>
+            <tbody>
+    """
+
+def _item_cells(item):
+    """Option counts of one item_rows() entry, then the 'other' count."""
+    return list(item['options'].values()) + [item['other']]
+
+def _item_headers(items):
+    return list(items[0]['options']) + ["Other"]
+
+def write_items_html(items, fp):
+    """Appends the per-question analysis table (services.analytics.item_rows)."""
+    headers = "".join(f"<th>{escape(h)}</th>" for h in _item_headers(items))
+    fp.write(HTML_ITEMS_HEAD.format(option_headers=headers).encode('utf-8'))
+    chunk = []
+    for item in items:
+        cells = [item['question'], escape(item['key']), f"{item['correct_rate']}%", item['discrimination']]
+        cells += _item_cells(item)
+        chunk.append("<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>\n")
+    fp.write("".join(chunk).encode('utf-8'))
+    fp.write(HTML_TABLE_END.encode('utf-8'))
+
+def write_leaderboard_html(test_title, submissions, fp, items=None):
+    """
+    Streams the leaderboard as UTF-8 HTML into the binary file object fp.
+    submissions: iterable of dict-like rows, already in rank order. Rows are
+    consumed one at a time, so memory use doesn't depend on how many there are.
+    items: optional per-question analysis rows, added as a second table.
+    Returns the number of rows written.
+    """
+    fp.write(HTML_HEAD.format(title=escape(str(test_title))).encode('utf-8'))
+
+    count = 0
+    chunk = []
+    for count, sub in enumerate(submissions, 1):
+        # sub keys: full_name, username, correct_count, wrong_count, percent, time_taken_seconds, submitted_at
+        user_display = f"@{sub['username']}" if sub['username'] else "N/A"
+        chunk.append(HTML_ROW.format(
+            rank=count,
+            name=escape(str(sub['full_name'] or "")),
+            user=escape(user_display),
+            correct=sub['correct_count'],
+            wrong=sub['wrong_count'],
+            percent=sub['percent'],
+            time=format_time_taken(sub['time_taken_seconds'] or 0),
+            submitted_at=escape(str(sub['submitted_at'])),
+        ))
+        if len(chunk) >= ROWS_PER_CHUNK:
+            fp.write("".join(chunk).encode('utf-8'))
+            chunk = []
+    if chunk:
+        fp.write("".join(chunk).encode('utf-8'))
+    fp.write(HTML_TABLE_END.encode('utf-8'))
+
+    if items:
+        write_items_html(items, fp)
+    fp.write(HTML_TAIL.encode('utf-8'))
+    return count
+
+def export_leaderboard_html(test_title, submissions, items=None):
+    """
+    Renders the leaderboard into a spooled temp file (in memory while small,
+    on disk once large). Returns (file positioned at 0, row count).
+    """
+    fp = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    count = write_leaderboard_html(test_title, submissions, fp, items)
+    fp.seek(0)
+    return fp, count
+
+NO_REGION = "Ko'rsatilmagan"
+
+def _xlsx_text(ws, value):
+    """User-supplied text for a write-only sheet: strips characters XML can't
+    hold and keeps a leading '=' from being stored as a formula."""
+    if not value:
+        return value
+    value = ILLEGAL_CHARACTERS_RE.sub("", str(value))
+    if value.startswith("="):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.data_type = 's'
+        return cell
+    return value
+
+def write_leaderboard_xlsx(test_title, submissions, region_submissions, fp, num_questions, answer_key=None, items=None):
+    """
+    Streams the leaderboard as an XLSX workbook into the binary file object fp.
+    Uses openpyxl's write-only mode, so rows go straight to disk and memory
+    stays flat however many participants there are.
+
+    submissions: rows in rank order, with region and normalized_answers.
+        They fill the "Reyting" and "Javoblar" sheets in one pass.
+    region_submissions: the same rows grouped by region, for "Hududlar".
+    items: optional per-question analysis rows, written to a "Tahlil" sheet.
+    Returns the number of participants.
+    """
+    wb = Workbook(write_only=True)
+    ranking = wb.create_sheet("Reyting")
+    regions = wb.create_sheet("Hududlar")
+    answers = wb.create_sheet("Javoblar")
+
+    ranking.append([_xlsx_text(ranking, f"Leaderboard: {test_title}")])
+    ranking.append(["Rank", "Name", "User", "Region", "Correct", "Wrong", "Percent", "Time", "Submitted At"])
+    question_headers = [f"Q{i}" for i in range(1, num_questions + 1)]
+    answers.append(["Rank", "Name"] + question_headers)
+    if answer_key:
+        answers.append(["", "Kalit"] + list(answer_key))
+
+    count = 0
+    for count, sub in enumerate(submissions, 1):
+        user_display = f"@{sub['username']}" if sub['username'] else "N/A"
+        ranking.append([
+            count, _xlsx_text(ranking, sub['full_name']), _xlsx_text(ranking, user_display),
+            _xlsx_text(ranking, sub['region'] or NO_REGION),
+            sub['correct_count'], sub['wrong_count'], sub['percent'],
+            format_time_taken(sub['time_taken_seconds'] or 0), str(sub['submitted_at']),
+        ])
+        answers.append([count, _xlsx_text(answers, sub['full_name'])] + list(sub['normalized_answers'] or ""))
+
+    regions.append(["Region", "Region Rank", "Name", "User", "Correct", "Wrong", "Percent", "Time"])
+    current_region = None
+    region_rank = 0
+    for sub in region_submissions:
+        region = sub['region'] or NO_REGION
+        if region != current_region:
+            current_region = region
+            region_rank = 0
+        region_rank += 1
+        user_display = f"@{sub['username']}" if sub['username'] else "N/A"
+        regions.append([
+            _xlsx_text(regions, region), region_rank,
+            _xlsx_text(regions, sub['full_name']), _xlsx_text(regions, user_display),
+            sub['correct_count'], sub['wrong_count'], sub['percent'],
+            format_time_taken(sub['time_taken_seconds'] or 0),
+        ])
+
+    if items:
+        analysis = wb.create_sheet("Tahlil")
+        analysis.append(["Question", "Key", "Correct %", "Discrimination"] + _item_headers(items))
+        for item in items:
+            analysis.append(
+                [item['question'], item['key'], item['correct_rate'], item['discrimination']] + _item_cells(item)
+            )
+
+    wb.save(fp)
+    return count
+
+def export_leaderboard_xlsx(test_title, submissions, region_submissions, num_questions, answer_key=None, items=None):
+    """Like export_leaderboard_html, for the XLSX workbook."""
+    fp = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    count = write_leaderboard_xlsx(test_title, submissions, region_submissions, fp, num_questions, answer_key, items)
+    fp.seek(0)
+    return fp, count
+
+def generate_leaderboard_html(test_title, submissions):
+    """
+    Generates a simple HTML table for the leaderboard.
+    submissions: list of dict-like objects (from db query)
+    """
+    buf = BytesIO()
+    write_leaderboard_html(test_title, submissions, buf)
+    return buf.getvalue().decode('utf-8')
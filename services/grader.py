@@ -1,4 +1,7 @@
 import re
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
 
 def normalize_answers(input_str: str) -> str:
     """
@@ -63,3 +66,157 @@ def grade_submission(normalized_submission: str, answer_key: str):
     percent = (correct / total) * 100.0
     
     return correct, wrong, round(percent, 2)
+
+def encode_answers(answers, width):
+    """
+    Packs answer strings into a (len(answers), width) matrix, one row per
+    string, truncated or padded with 0 to `width`. Letters are ASCII in
+    practice and give a uint8 matrix; anything else falls back to uint32
+    code points so comparisons stay exact.
+    """
+    if width == 0 or not answers:
+        return np.zeros((len(answers), width), dtype=np.uint8)
+    try:
+        buf = b"".join(a.encode('ascii')[:width].ljust(width, b"\0") for a in answers)
+        return np.frombuffer(buf, dtype=np.uint8).reshape(len(answers), width)
+    except UnicodeEncodeError:
+        buf = b"".join(a[:width].ljust(width, "\0").encode('utf-32-le') for a in answers)
+        return np.frombuffer(buf, dtype='<u4').reshape(len(answers), width)
+
+# --- Scoring plans ---
+# A plan gives each question its accepted letters, a weight and a penalty for
+# a wrong answer. Written one token per question, in order:
+#     A        one point for A
+#     B/C      B or C accepted
+#     D*2      worth 2 points
+#     A*1.5!1  1.5 points, 1 point deducted when answered wrong
+# An optional first token "!0.25" sets the penalty of every question without
+# one. Numbering before a token ("12.A/B") is ignored.
+PLAN_TOKEN_RE = re.compile(r"^(?:\d+[.)-]?)?([A-Z](?:/[A-Z])*)(?:\*(\d+(?:\.\d+)?))?(?:!(\d+(?:\.\d+)?))?$")
+DEFAULT_PENALTY_RE = re.compile(r"^!(\d+(?:\.\d+)?)$")
+
+# Lookup tables have a column per byte value; codes past 255 share the last one
+PLAN_COLUMNS = 257
+
+# key: the first accepted letter of each question (stored as tests.answer_key).
+# points / accepted: (num_questions, PLAN_COLUMNS) tables indexed by answer code.
+# simple: one letter, weight 1 and no penalty everywhere, graded exactly like
+# grade_submission.
+ScoringPlan = namedtuple("ScoringPlan", ["key", "spec", "points", "accepted", "max_score", "simple"])
+
+def is_plan_text(text: str) -> bool:
+    """Whether an admin's key message uses the scoring plan syntax."""
+    return any(c in text for c in "/*!")
+
+def parse_plan(text: str):
+    """
+    Parses plan text into [(letters, weight, penalty)], one per question.
+    Raises ValueError with the offending token on bad syntax.
+    """
+    tokens = [t for t in re.split(r"[\s,;]+", text.upper()) if t]
+    default_penalty = 0.0
+    if tokens and DEFAULT_PENALTY_RE.match(tokens[0]):
+        default_penalty = float(tokens.pop(0)[1:])
+    questions = []
+    for token in tokens:
+        match = PLAN_TOKEN_RE.match(token)
+        if not match:
+            raise ValueError(token)
+        letters, weight, penalty = match.groups()
+        weight = float(weight) if weight is not None else 1.0
+        if weight <= 0:
+            raise ValueError(token)
+        penalty = float(penalty) if penalty is not None else default_penalty
+        questions.append((letters.replace("/", ""), weight, penalty))
+    return questions
+
+def format_plan(questions) -> str:
+    """Canonical text of parsed plan questions, as stored in tests.scoring_plan."""
+    tokens = []
+    for letters, weight, penalty in questions:
+        token = "/".join(letters)
+        if weight != 1:
+            token += f"*{weight:g}"
+        if penalty:
+            token += f"!{penalty:g}"
+        tokens.append(token)
+    return " ".join(tokens)
+
+@lru_cache(maxsize=256)
+def compile_plan(answer_key: str, spec: str = None) -> ScoringPlan:
+    """
+    Compiles a key, or a plan text, into lookup tables once; the result is
+    kept on the cached TestMeta. Without a spec every question accepts its
+    key letter for one point.
+    """
+    questions = parse_plan(spec) if spec else [(letter, 1.0, 0.0) for letter in answer_key]
+    total = len(questions)
+    points = np.zeros((total, PLAN_COLUMNS), dtype=np.float64)
+    accepted = np.zeros((total, PLAN_COLUMNS), dtype=bool)
+    for q, (letters, weight, penalty) in enumerate(questions):
+        # Any answer scores -penalty, except accepted letters and padding (code 0)
+        points[q, 1:] = -penalty
+        for letter in letters:
+            code = min(ord(letter), PLAN_COLUMNS - 1)
+            points[q, code] = weight
+            accepted[q, code] = True
+    simple = all(len(letters) == 1 and weight == 1 and not penalty for letters, weight, penalty in questions)
+    key = "".join(letters[0] for letters, _, _ in questions)
+    max_score = sum(weight for _, weight, _ in questions)
+    return ScoringPlan(key, spec, points, accepted, max_score, simple)
+
+def plan_columns(matrix):
+    """Answer codes of an encode_answers() matrix as plan table columns."""
+    if matrix.dtype == np.uint8:
+        return matrix
+    return np.minimum(matrix, PLAN_COLUMNS - 1)
+
+def _grade_plan(plan, submissions):
+    n = len(submissions)
+    total = len(plan.key)
+    columns = plan_columns(encode_answers(submissions, total))
+    # One gather per table: every question is scored the same way
+    rows = np.arange(total)
+    correct = plan.accepted[rows, columns].sum(axis=1, dtype=np.int64)
+    score = plan.points[rows, columns].sum(axis=1)
+    if not plan.max_score:
+        return correct, total - correct, np.zeros(n, dtype=np.float64)
+    percent = np.round(score / plan.max_score * 100.0, 2)
+    return correct, total - correct, percent
+
+def grade_with_plan(normalized_submission: str, answer_key: str, plan: ScoringPlan = None):
+    """
+    grade_submission with an optional scoring plan. A missing or simple plan
+    goes through grade_submission itself, so plain keys score exactly as before.
+    """
+    if plan is None or plan.simple:
+        return grade_submission(normalized_submission, answer_key)
+    correct, wrong, percent = _grade_plan(plan, [normalized_submission])
+    return int(correct[0]), int(wrong[0]), float(percent[0])
+
+def grade_batch(answer_key: str, submissions, plan: ScoringPlan = None):
+    """
+    Grades many normalized submissions against one key in a single
+    vectorized pass. Returns (correct, wrong, percent) numpy arrays whose
+    values equal grade_with_plan's for each submission.
+    """
+    if plan is not None and not plan.simple:
+        return _grade_plan(plan, submissions)
+
+    total = len(answer_key)
+    n = len(submissions)
+    if total == 0:
+        return np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.float64)
+
+    matrix = encode_answers(submissions, total)
+    key = encode_answers([answer_key], total)[0]
+    if matrix.dtype != key.dtype:
+        matrix, key = matrix.astype(np.uint32), key.astype(np.uint32)
+
+    # Padding (0) never equals a key letter, so short submissions score like zip()
+    correct = (matrix == key).sum(axis=1, dtype=np.int64)
+    wrong = total - correct
+    # Percent only depends on the correct count: look it up from values computed
+    # exactly as grade_submission does, so rounding matches to the last bit
+    percent_table = np.array([round((c / total) * 100.0, 2) for c in range(total + 1)])
+    return correct, wrong, percent_table[correct]
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from telegram.error import BadRequest
+import db.async_queries as db
+from db.cache import get_results_version
+from db.queries import iter_test_submissions
+from services.exporter import export_leaderboard_html, export_leaderboard_xlsx
+from services.analytics import compute_item_analysis, item_rows
+
+logger = logging.getLogger(__name__)
+
+# A leaderboard file already uploaded to Telegram. `version` is the test's
+# results version it was rendered from; file_id lets us resend it for free.
+# A resend keeps the uploaded filename, so it is only reused for that name.
+CachedLeaderboard = namedtuple("CachedLeaderboard", ["version", "file_id", "count", "filename"])
+
+FORMATS = ("html", "xlsx")
+
+_uploaded = {}  # (test_id, fmt) -> CachedLeaderboard
+_render_locks = {}  # (test_id, fmt) -> [asyncio.Lock, holders and waiters], one render per file at a time
+
+@asynccontextmanager
+async def _render_lock(key):
+    # Dropped once nobody holds or waits for it, so the dict doesn't grow with every test
+    entry = _render_locks.get(key)
+    if entry is None:
+        entry = _render_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _render_locks[key]
+
+def render_leaderboard(test, fmt):
+    """Blocking: streams the test's rows into a file. Returns (file, count)."""
+    test_id = test['id']
+    items = item_rows(compute_item_analysis(test)) if test['answer_key'] else None
+    if fmt == "xlsx":
+        return export_leaderboard_xlsx(
+            test['title'],
+            iter_test_submissions(test_id, with_answers=True),
+            iter_test_submissions(test_id, by_region=True),
+            test['num_questions'],
+            test['answer_key'],
+            items,
+        )
+    return export_leaderboard_html(test['title'], iter_test_submissions(test_id), items)
+
+def default_filename(test_id, fmt, version):
+    return f"leaderboard_test_{test_id}_v{version}.{fmt}"
+
+def get_cached(test_id, fmt="html", filename=None):
+    """The uploaded file for this test, or None if missing, out of date or named differently."""
+    entry = _uploaded.get((test_id, fmt))
+    if entry is None or entry.version != get_results_version(test_id):
+        return None
+    if filename is not None and entry.filename != filename:
+        return None
+    return entry
+
+async def send_leaderboard(bot, chat_id, test, make_caption, filename=None, fmt="html"):
+    """
+    Sends the test's leaderboard file to chat_id.
+
+    The first send renders and uploads it. Later sends, to any chat, reuse the
+    Telegram file_id until a new submission or a regrade changes the results.
+    make_caption(count) builds the caption. The default filename carries the
+    results version, so a resent file is named after the results it holds.
+    Returns the participant count; nothing is sent when it is 0.
+    """
+    test_id = test['id']
+    key = (test_id, fmt)
+
+    entry = get_cached(test_id, fmt, filename)
+    if entry is not None:
+        try:
+            await bot.send_document(
+                chat_id=chat_id, document=entry.file_id, caption=make_caption(entry.count), parse_mode='HTML'
+            )
+            return entry.count
+        except BadRequest as e:
+            # file_id no longer accepted: fall through and upload again
+            logger.warning(f"Cached leaderboard for test #{test_id} rejected: {e}")
+            _uploaded.pop(key, None)
+
+    async with _render_lock(key):
+        # Someone else may have uploaded it while we waited
+        entry = get_cached(test_id, fmt, filename)
+        if entry is not None:
+            await bot.send_document(
+                chat_id=chat_id, document=entry.file_id, caption=make_caption(entry.count), parse_mode='HTML'
+            )
+            return entry.count
+
+        version = get_results_version(test_id)
+        name = filename or default_filename(test_id, fmt, version)
+        file_obj, count = await db.run_sync(render_leaderboard, test, fmt)
+        with file_obj:
+            if not count:
+                return 0
+            message = await bot.send_document(
+                chat_id=chat_id,
+                document=file_obj,
+                filename=name,
+                caption=make_caption(count),
+                parse_mode='HTML'
+            )
+        # Keyed to the version read before rendering, so a submission that
+        # landed meanwhile makes this entry stale rather than wrong
+        if message is not None and message.document is not None:
+            _uploaded[key] = CachedLeaderboard(version, message.document.file_id, count, name)
+        return count
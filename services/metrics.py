@@ -0,0 +1,323 @@
+"""
+Latency histograms and error counters for handlers, database queries,
+Telegram API calls and scheduled jobs, served in the Prometheus text format
+on METRICS_LISTEN:METRICS_PORT/metrics and summarized in the admin stats view.
+
+With METRICS_ENABLED off nothing is wrapped: handlers, jobs, queries and
+the bot's request object are left as they are.
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+from bisect import bisect_left
+from telegram.request import BaseRequest
+import config
+
+logger = logging.getLogger(__name__)
+
+ENABLED = config.METRICS_ENABLED
+
+# Upper bounds in seconds; an implicit +Inf bucket follows
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram per label set, as Prometheus expects."""
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def snapshot(self):
+        """{label values: (count, sum, per-bucket counts)}"""
+        with self._lock:
+            return {key: (sum(s[:-1]), s[-1], s[:-1]) for key, s in self._series.items()}
+
+    def quantile(self, q, counts):
+        """Upper bound of the bucket holding the q-quantile (inf past the last bucket)."""
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (count, total, counts) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                labels = _labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+handler_seconds = Histogram("bluebot_handler_seconds", "Update handler callback latency.", ["handler"])
+handler_errors = Counter("bluebot_handler_errors_total", "Handler callbacks that raised.", ["handler"])
+query_seconds = Histogram("bluebot_db_query_seconds", "db.queries call latency, in the thread that runs it.", ["query"])
+query_errors = Counter("bluebot_db_query_errors_total", "db.queries calls that raised.", ["query"])
+api_seconds = Histogram("bluebot_telegram_api_seconds", "Telegram Bot API request latency.", ["method"])
+api_rate_limited = Counter("bluebot_telegram_api_429_total", "Telegram Bot API requests answered with 429.", ["method"])
+job_seconds = Histogram("bluebot_job_seconds", "JobQueue job duration.", ["job"])
+job_errors = Counter("bluebot_job_errors_total", "JobQueue jobs that raised.", ["job"])
+
+METRICS = [handler_seconds, handler_errors, query_seconds, query_errors,
+           api_seconds, api_rate_limited, job_seconds, job_errors]
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    # Point-in-time gauges from the update processor and the DB executor
+    from services.update_processor import update_processor
+    from db.async_queries import db_stats
+    updates = update_processor.stats()
+    for key in ('running', 'queued', 'active_chats'):
+        lines += [f"# TYPE bluebot_updates_{key} gauge", f"bluebot_updates_{key} {updates[key]}"]
+    for key, value in db_stats().items():
+        name = f"bluebot_db_executor_{key}_total"
+        lines += [f"# TYPE {name} counter", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+# --- Instrumentation ---
+def record_query(name, seconds, failed):
+    query_seconds.observe(seconds, name)
+    if failed:
+        query_errors.inc(name)
+
+
+def timed_query(func):
+    """
+    Decorator for db.queries functions. Times each call where it runs, so
+    calls from the executor, the writer thread, jobs and other blocking
+    helpers all count. For generators only the time spent producing rows
+    counts, not the consumer's.
+    """
+    if not ENABLED:
+        return func
+    name = func.__name__
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator(*args, **kwargs):
+            rows = func(*args, **kwargs)
+            elapsed, failed = 0.0, False
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(rows)
+                    except StopIteration:
+                        return
+                    except Exception:
+                        failed = True
+                        raise
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield item
+            finally:
+                rows.close()
+                record_query(name, elapsed, failed)
+        return generator
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record_query(name, time.perf_counter() - start, failed)
+    return wrapper
+
+
+def _timed_callback(callback, histogram, errors):
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            errors.inc(callback.__name__)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start, callback.__name__)
+    wrapper._metrics = True
+    return wrapper
+
+
+def timed_job(callback):
+    """Decorator for JobQueue callbacks."""
+    if not ENABLED:
+        return callback
+    return _timed_callback(callback, job_seconds, job_errors)
+
+
+def instrument_handlers(application):
+    """Times every handler callback, including those inside conversations."""
+    if not ENABLED:
+        return
+    from telegram.ext import ConversationHandler
+
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks:
+                wrap(inner)
+            for handlers in handler.states.values():
+                for inner in handlers:
+                    wrap(inner)
+            return
+        if not getattr(handler.callback, '_metrics', False):
+            handler.callback = _timed_callback(handler.callback, handler_seconds, handler_errors)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+
+class TimedRequest(BaseRequest):
+    """Wraps the bot's request object to time every API call and count 429s."""
+
+    def __init__(self, request):
+        self._request = request
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            status, payload = await self._request.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        finally:
+            api_seconds.observe(time.perf_counter() - start, endpoint)
+        if status == 429:
+            api_rate_limited.inc(endpoint)
+        return status, payload
+
+
+# --- HTTP endpoint ---
+_server = None
+
+async def _serve(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # skip headers
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+async def start_server():
+    global _server
+    if not ENABLED or _server is not None:
+        return
+    _server = await asyncio.start_server(_serve, config.METRICS_LISTEN, config.METRICS_PORT)
+    logger.info(f"Metrics on http://{config.METRICS_LISTEN}:{config.METRICS_PORT}/metrics")
+
+async def stop_server():
+    global _server
+    if _server is None:
+        return
+    _server.close()
+    await _server.wait_closed()
+    _server = None
+
+
+# --- Admin summary ---
+def slowest(histogram, n=3, q=0.95):
+    """[(label, count, q-quantile bucket bound)] for the n series with the highest quantile."""
+    rows = []
+    for label_values, (count, _, counts) in histogram.snapshot().items():
+        rows.append((label_values[0], count, histogram.quantile(q, counts)))
+    rows.sort(key=lambda r: (r[2], r[1]), reverse=True)
+    return rows[:n]
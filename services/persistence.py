@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+from telegram.ext import BasePersistence, PersistenceInput
+import db.async_queries as db
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePersistence(BasePersistence):
+    """
+    Keeps conversation states and user_data in our own database, so a
+    restart mid-exam doesn't drop half-finished registrations or wizards.
+
+    State lives in memory as usual. Every `update_interval` seconds the
+    Application hands over what changed; only entries whose JSON actually
+    differs from what is stored are kept, and they are written together in
+    one transaction (write-behind). user_data is loaded lazily, one user at
+    a time, the first time their update is handled; conversation states are
+    read per handler at startup, which is cheap because finished
+    conversations are deleted. chat_data, bot_data and callback_data are
+    not used by the bot and not stored.
+    """
+
+    def __init__(self, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._stored_user_data = {}  # user_id -> JSON as stored (None: no row)
+        self._dirty_user_data = {}  # user_id -> JSON to write (None: delete)
+        self._dirty_conversations = {}  # (name, conv_key JSON) -> state JSON to write (None: delete)
+        self._flush_task = None
+
+    # --- Loading ---
+    async def get_user_data(self):
+        return {}  # see refresh_user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await db.load_conversations(name)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Called before every callback; only the first call per user reads the DB
+        if user_id in self._stored_user_data:
+            return
+        stored = await db.load_user_data(user_id)
+        if user_id in self._stored_user_data:
+            return  # another update of this user loaded it meanwhile
+        self._stored_user_data[user_id] = stored
+        if stored:
+            for key, value in json.loads(stored).items():
+                user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Saving ---
+    async def update_user_data(self, user_id, data):
+        # The Application marks every user who sent an update, changed or not
+        encoded = json.dumps(data, sort_keys=True) if data else None
+        if encoded == self._stored_user_data.get(user_id):
+            return
+        self._stored_user_data[user_id] = encoded
+        self._dirty_user_data[user_id] = encoded
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        if self._stored_user_data.get(user_id) is not None or user_id in self._dirty_user_data:
+            self._stored_user_data[user_id] = None
+            self._dirty_user_data[user_id] = None
+            self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        self._dirty_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    def _schedule_flush(self):
+        # update_persistence() starts all of a round's update_* calls at once,
+        # so a flush task created by the first one runs after the rest and
+        # writes the whole round as one batch
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_dirty())
+
+    async def _write_dirty(self):
+        user_data, self._dirty_user_data = self._dirty_user_data, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not user_data and not conversations:
+            return
+        try:
+            await db.save_persistence(user_data, conversations)
+        except Exception as e:
+            logger.error(f"Failed to save bot state ({len(user_data)} users, {len(conversations)} conversations): {e}")
+            # Retry with the next batch, unless newer values arrived meanwhile
+            for user_id, data in user_data.items():
+                self._dirty_user_data.setdefault(user_id, data)
+            for key, state in conversations.items():
+                self._dirty_conversations.setdefault(key, state)
+
+    async def flush(self):
+        """Called on shutdown, after the last update_persistence()."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_dirty()
+
+
+persistence = DatabasePersistence(update_interval=config.PERSISTENCE_FLUSH_INTERVAL)
@@ -0,0 +1,109 @@
+import logging
+from sortedcontainers import SortedList
+import db.async_queries as db
+from db.queries import iter_test_submissions
+
+logger = logging.getLogger(__name__)
+
+
+def _rank_key(percent, correct, time_taken):
+    # Same order as the leaderboard query:
+    # percent DESC, correct_count DESC, time_taken_seconds ASC
+    return (-(percent or 0), -(correct or 0), time_taken or 0)
+
+
+class RankIndex:
+    """
+    In-memory ranking of one active test's submissions.
+
+    Entries sit in a SortedList (a B-tree-like list of short sorted runs), so
+    inserting a submission and looking up a rank are both O(log n), and the
+    top N is a slice. Ties share a rank (1, 2, 2, 4).
+
+    All methods must run on the event loop thread. The index is filled from
+    the database in the background: anything recorded meanwhile is kept and
+    merged with the loaded rows, so no submission is lost or counted twice.
+    """
+
+    def __init__(self):
+        self._entries = SortedList()  # (key..., submission_id)
+        self._names = {}  # submission_id -> (full_name, percent, correct_count)
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, submission_id, percent, correct, time_taken, full_name):
+        if submission_id in self._names:
+            return
+        self._entries.add(_rank_key(percent, correct, time_taken) + (submission_id,))
+        self._names[submission_id] = (full_name, percent, correct)
+
+    def rank_of(self, percent, correct, time_taken):
+        """1-based rank a result with these scores has right now."""
+        return self._entries.bisect_left(_rank_key(percent, correct, time_taken)) + 1
+
+    def top(self, n):
+        """[(rank, full_name, percent, correct_count)] for the best n entries."""
+        result = []
+        for entry in self._entries.islice(stop=n):
+            full_name, percent, correct = self._names[entry[-1]]
+            result.append((self._entries.bisect_left(entry[:-1]) + 1, full_name, percent, correct))
+        return result
+
+    def merge_loaded(self, rows):
+        """rows: (key, submission_id, full_name, percent, correct) in rank order."""
+        live = [(e, self._names[e[-1]]) for e in self._entries]
+        self._entries = SortedList(key + (submission_id,) for key, submission_id, _, _, _ in rows)
+        self._names = {submission_id: (name, percent, correct) for _, submission_id, name, percent, correct in rows}
+        # Submissions recorded while loading may also be among the rows
+        for entry, info in live:
+            if entry[-1] not in self._names:
+                self._entries.add(entry)
+                self._names[entry[-1]] = info
+        self.loaded = True
+
+
+_indexes = {}  # test_id -> RankIndex, for active tests only
+
+def _read_entries(test_id):
+    # Already in leaderboard order, so no sorting is needed on load
+    return [
+        (_rank_key(r['percent'], r['correct_count'], r['time_taken_seconds']),
+         r['id'], r['full_name'], r['percent'], r['correct_count'])
+        for r in iter_test_submissions(test_id)
+    ]
+
+async def load_index(test_id):
+    """(Re)builds the index of an active test from the database."""
+    index = RankIndex()
+    _indexes[test_id] = index
+    rows = await db.run_sync(_read_entries, test_id)
+    if _indexes.get(test_id) is index:
+        index.merge_loaded(rows)
+        logger.info(f"Rank index for test #{test_id} loaded ({len(index)} submissions)")
+    return index
+
+async def load_active_indexes():
+    """Called at startup: rebuilds the indexes of all running tests."""
+    for test in await db.get_active_tests():
+        await load_index(test['id'])
+
+def drop_index(test_id):
+    _indexes.pop(test_id, None)
+
+def get_index(test_id):
+    return _indexes.get(test_id)
+
+def record_submission(test_id, submission_id, percent, correct, time_taken, full_name):
+    """
+    Adds a new submission to its test's index. Returns (rank, total), or
+    None when the test has no index yet or it is still loading.
+    """
+    index = _indexes.get(test_id)
+    if index is None:
+        return None
+    index.add(submission_id, percent, correct, time_taken, full_name)
+    if not index.loaded:
+        return None
+    return index.rank_of(percent, correct, time_taken), len(index)
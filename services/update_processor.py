@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import deque
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import config
+
+# Waits kept for the percentiles in stats()
+WAIT_SAMPLES = 2000
+# Handed to the base class, whose own slot limit is taken before the chat's turn
+UNLIMITED = 2 ** 31 - 1
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles up to `max_concurrent_updates` updates at once, but never two
+    from the same chat: those run one after another, in arrival order.
+
+    The conversations (registration, the admin wizards) and the
+    duplicate-submission check assume a chat's updates are handled in
+    order, so they keep working, while a slow send or query for one student
+    no longer holds up everyone queued behind them.
+
+    An update first waits for its chat, then for a free slot, so a chat with
+    a backlog occupies one slot rather than one per queued update. The base
+    class takes its own slot before do_process_update, so it is given a
+    limit it never reaches and the real one is enforced here.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(UNLIMITED)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chats = {}  # chat key -> [asyncio.Lock, updates holding or waiting for it]
+        self._queued = 0
+        self._running = 0
+        self._processed = 0
+        self._peak_queued = 0
+        self._chat_waits = deque(maxlen=WAIT_SAMPLES)
+        self._slot_waits = deque(maxlen=WAIT_SAMPLES)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        self._queued += 1
+        self._peak_queued = max(self._peak_queued, self._queued)
+        queued_at = time.perf_counter()
+        entry = None
+        holds_chat = started = False
+        try:
+            if key is not None:
+                entry = self._chats.get(key)
+                if entry is None:
+                    entry = self._chats[key] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                await entry[0].acquire()
+                holds_chat = True
+            chat_ready = time.perf_counter()
+            self._chat_waits.append(chat_ready - queued_at)
+            async with self._slots:
+                self._slot_waits.append(time.perf_counter() - chat_ready)
+                self._queued -= 1
+                self._running += 1
+                started = True
+                try:
+                    await coroutine
+                finally:
+                    self._running -= 1
+                    self._processed += 1
+        finally:
+            if not started:
+                # Cancelled while waiting (shutdown)
+                self._queued -= 1
+                coroutine.close()
+            if entry is not None:
+                if holds_chat:
+                    entry[0].release()
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chats[key]
+
+    def stats(self):
+        """
+        Updates running and waiting (for their chat or a slot), and those
+        waits, for the admin stats view and the load test.
+        """
+        chat_waits = list(self._chat_waits)
+        slot_waits = list(self._slot_waits)
+        return {
+            'limit': self.limit,
+            'running': self._running,
+            'queued': self._queued,
+            'peak_queued': self._peak_queued,
+            'processed': self._processed,
+            'active_chats': len(self._chats),
+            'chat_wait_p50': _percentile(chat_waits, 50),
+            'chat_wait_p95': _percentile(chat_waits, 95),
+            'chat_wait_max': max(chat_waits, default=0.0),
+            'slot_wait_p95': _percentile(slot_waits, 95),
+        }
+
+
+update_processor = ChatOrderedUpdateProcessor(config.UPDATE_CONCURRENCY)
@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import db.init_db as init_db
+import db.queries as q
+from db.cache import test_cache, user_cache
+
+
+class TempDatabaseTestCase(unittest.TestCase):
+    """Each test gets a fresh SQLite file, opened through the same pool as in production."""
+
+    def setUp(self):
+        workdir = tempfile.mkdtemp(prefix="bluebot-test-")
+        self.addCleanup(shutil.rmtree, workdir, ignore_errors=True)
+        path = os.path.join(workdir, "test.db")
+        for module in (q, init_db):
+            patcher = mock.patch.multiple(module, DB_PATH=path, DATABASE_URL=None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        q.close_pool()
+        self.addCleanup(q.close_pool)
+        test_cache.clear()
+        user_cache.clear()
+        init_db.init_db()
+
+    def make_test(self, key="ABCDE"):
+        test_id = q.create_test("Test", len(key), 1)
+        q.update_test_answer_key(test_id, key)
+        return test_id
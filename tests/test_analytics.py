@@ -0,0 +1,93 @@
+import unittest
+from unittest import mock
+from db.cache import bump_results_version
+from services import analytics
+from services.analytics import analyze_submissions, compute_item_analysis, item_rows, OTHER
+from services.grader import compile_plan
+
+# Key ABC, in rank order (best first). Rows 1 and 2 both score 2 and straddle
+# the 27% cut; row 3 left question 3 blank and row 4 answered nothing.
+KEY = "ABC"
+RANKED = ["ABC", "ABD", "AXC", "AC", ""]
+
+class TestItemAnalysis(unittest.TestCase):
+    def test_hand_computed(self):
+        a = analyze_submissions(KEY, RANKED, len(RANKED))
+        self.assertEqual(a.participants, 5)
+        self.assertEqual(a.group_size, 2)  # ceil(5 * 0.27)
+        self.assertEqual(a.correct_rate.tolist(), [80.0, 40.0, 40.0])
+        # upper = rows 0-1, lower = rows 3-4
+        self.assertEqual(a.discrimination.tolist(), [0.5, 1.0, 0.5])
+
+    def test_tie_at_cut_split_by_position(self):
+        # Swapping the tied rows moves the other one into the upper group
+        a = analyze_submissions(KEY, ["ABC", "AXC", "ABD", "AC", ""], 5)
+        self.assertEqual(a.group_size, 2)
+        self.assertEqual(a.discrimination.tolist(), [0.5, 0.5, 1.0])
+        self.assertEqual(a.correct_rate.tolist(), [80.0, 40.0, 40.0])
+
+    def test_unanswered_counted_as_other(self):
+        a = analyze_submissions(KEY, RANKED, len(RANKED))
+        self.assertEqual(a.counts[0, 0], 4)  # A
+        self.assertEqual(a.counts[0, OTHER], 1)
+        self.assertEqual(a.counts[2, 2], 2)  # C
+        self.assertEqual(a.counts[2, 3], 1)  # D
+        self.assertEqual(a.counts[2, OTHER], 2)
+        self.assertEqual(int(a.counts.sum()), 5 * 3)
+
+    def test_fewer_than_four(self):
+        a = analyze_submissions("AB", ["AB", "AA", "BB"], 3)
+        self.assertEqual(a.group_size, 1)
+        self.assertEqual(a.correct_rate.tolist(), [66.7, 66.7])
+        self.assertEqual(a.discrimination.tolist(), [1.0, 0.0])
+
+        # One participant is both groups at once
+        a = analyze_submissions("AB", ["AB"], 1)
+        self.assertEqual(a.group_size, 1)
+        self.assertEqual(a.discrimination.tolist(), [0.0, 0.0])
+
+    def test_no_submissions(self):
+        a = analyze_submissions("AB", [], 0)
+        self.assertEqual(a.participants, 0)
+        self.assertEqual(a.group_size, 0)
+        self.assertEqual(a.correct_rate.tolist(), [0.0, 0.0])
+        self.assertEqual(a.discrimination.tolist(), [0.0, 0.0])
+
+    def test_plan_accepts_alternatives(self):
+        plan = compile_plan("AB", "A/B B")
+        a = analyze_submissions("AB", ["BB", "AC", "CB"], 3, plan)
+        self.assertEqual(a.correct_rate.tolist(), [66.7, 66.7])
+        self.assertEqual(a.scoring_plan, "A/B B")
+
+    def test_item_rows(self):
+        rows = item_rows(analyze_submissions(KEY, RANKED, len(RANKED)))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1]['question'], 2)
+        self.assertEqual(rows[1]['key'], "B")
+        self.assertEqual(rows[1]['correct_rate'], 40.0)
+        self.assertEqual(rows[1]['discrimination'], 1.0)
+        self.assertEqual(rows[1]['options']['B'], 2)
+        self.assertEqual(rows[1]['options']['X'], 1)
+        self.assertEqual(rows[1]['other'], 1)
+        # Letters run from A to the last one anyone chose
+        self.assertEqual(list(rows[0]['options']), list("ABCDEFGHIJKLMNOPQRSTUVWX"))
+
+        plan_rows = item_rows(analyze_submissions("AB", ["BB"], 1, compile_plan("AB", "A/B B")))
+        self.assertEqual([r['key'] for r in plan_rows], ["A/B", "B"])
+
+    def test_compute_item_analysis_cached_per_version(self):
+        test = {'id': 90015, 'answer_key': KEY, 'scoring_plan': None}
+        rows = [{'normalized_answers': a or None} for a in RANKED]
+        with mock.patch.object(analytics, "get_submission_count", return_value=len(rows)), \
+             mock.patch.object(analytics, "iter_test_submissions", return_value=rows) as read:
+            first = compute_item_analysis(test)
+            self.assertEqual(first.correct_rate.tolist(), [80.0, 40.0, 40.0])
+            self.assertIs(compute_item_analysis(test), first)
+            self.assertEqual(read.call_count, 1)
+
+            bump_results_version(test['id'])
+            self.assertIsNot(compute_item_analysis(test), first)
+            self.assertEqual(read.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,9 @@
+import random
 import unittest
-from services.grader import normalize_answers, grade_submission
+from services.grader import (
+    normalize_answers, grade_submission, grade_batch, grade_with_plan,
+    compile_plan, parse_plan, format_plan, is_plan_text
+)
 
 class TestGrader(unittest.TestCase):
     def test_normalize_letters(self):
@@ -39,5 +43,80 @@ class TestGrader(unittest.TestCase):
         self.assertEqual(w, 1) # Total 3, 2 correct -> 1 wrong
         self.assertAlmostEqual(p, 66.67, places=2)
 
+class TestGradeBatch(unittest.TestCase):
+    def assertMatchesSingle(self, key, subs):
+        correct, wrong, percent = grade_batch(key, subs)
+        expected = [grade_submission(sub, key) for sub in subs]
+        self.assertEqual(list(zip(correct.tolist(), wrong.tolist(), percent.tolist())), expected)
+
+    def test_batch_basic(self):
+        self.assertMatchesSingle("ABCDE", ["ABCDE", "ABXDE", "EDCBA", ""])
+
+    def test_batch_length_mismatch(self):
+        # Shorter submissions grade like zip(); longer ones are truncated
+        self.assertMatchesSingle("ABC", ["AB", "ABCD", "A", "CCCCCC"])
+
+    def test_batch_empty(self):
+        self.assertMatchesSingle("", ["ABC", ""])
+        self.assertMatchesSingle("ABC", [])
+
+    def test_batch_non_ascii(self):
+        # normalize_answers keeps any alphabetic character
+        self.assertMatchesSingle("ABВ", ["ABВ", "ABB", "АBВ"])
+
+    def test_batch_random_matches_single(self):
+        rng = random.Random(42)
+        for total in (1, 3, 7, 45, 90, 300):
+            key = "".join(rng.choice("ABCDE") for _ in range(total))
+            subs = [
+                "".join(rng.choice("ABCDE") for _ in range(total + rng.choice((-1, 0, 0, 0, 1))))
+                for _ in range(200)
+            ]
+            self.assertMatchesSingle(key, subs)
+
+class TestScoringPlan(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            parse_plan("!0.25 1.A 2.b/c D*2 A*1.5!1"),
+            [("A", 1.0, 0.25), ("BC", 1.0, 0.25), ("D", 2.0, 0.25), ("A", 1.5, 1.0)]
+        )
+        self.assertEqual(format_plan(parse_plan("A B/C D*2!0.5")), "A B/C D*2!0.5")
+        with self.assertRaises(ValueError):
+            parse_plan("A B*x")
+        self.assertTrue(is_plan_text("A B/C"))
+        self.assertFalse(is_plan_text("1-A, 2-B"))
+
+    def test_plain_key_is_simple(self):
+        plan = compile_plan("ABCD")
+        self.assertTrue(plan.simple)
+        self.assertEqual(plan.key, "ABCD")
+        self.assertTrue(compile_plan("", "A B C D").simple)
+        for sub in ("ABCD", "ABXD", "DCBA", "AB"):
+            self.assertEqual(grade_with_plan(sub, "ABCD", plan), grade_submission(sub, "ABCD"))
+
+    def test_weights_alternatives_and_penalties(self):
+        plan = compile_plan("", "A B/C D*2 A!1")
+        self.assertFalse(plan.simple)
+        self.assertEqual(plan.key, "ABDA")
+        self.assertEqual(plan.max_score, 5)
+        # 1 + 1 + 2 + 1 = 5 of 5
+        self.assertEqual(grade_with_plan("ACDA", plan.key, plan), (4, 0, 100.0))
+        # 1 + 0 + 2 - 1 = 2 of 5
+        self.assertEqual(grade_with_plan("AEDB", plan.key, plan), (2, 2, 40.0))
+        # Missing answers neither score nor cost points
+        self.assertEqual(grade_with_plan("A", plan.key, plan), (1, 3, 20.0))
+
+    def test_batch_matches_single(self):
+        rng = random.Random(7)
+        spec = " ".join(
+            rng.choice("ABCDE") + rng.choice(("", "/B", "/C")) + rng.choice(("", "*2", "*0.5")) + rng.choice(("", "!0.25"))
+            for _ in range(40)
+        )
+        plan = compile_plan("", spec)
+        subs = ["".join(rng.choice("ABCDEВ") for _ in range(40)) for _ in range(100)]
+        correct, wrong, percent = grade_batch(plan.key, subs, plan=plan)
+        expected = [grade_with_plan(sub, plan.key, plan) for sub in subs]
+        self.assertEqual(list(zip(correct.tolist(), wrong.tolist(), percent.tolist())), expected)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+import db.queries as q
+from db.cache import MISSING, test_cache
+from dbtest import TempDatabaseTestCase
+
+NOW = datetime(2026, 1, 1, 9, 0)
+
+class TestUpsertUser(TempDatabaseTestCase):
+    def test_new_and_existing(self):
+        first = q.upsert_user(1, "a", "Ali")
+        second = q.upsert_user(2, "b", "Vali")
+        self.assertNotEqual(first, second)
+        self.assertEqual(q.upsert_user(1, "a", "Ali Valiyev"), first)
+        self.assertEqual(q.get_registered_user(1), {'id': first, 'full_name': "Ali Valiyev"})
+
+    def test_existing_after_other_insert(self):
+        # The connection is reused, so lastrowid would still point at the submission
+        first = q.upsert_user(1, "a", "Ali")
+        second = q.upsert_user(2, "b", "Vali")
+        test_id = self.make_test()
+        q.insert_submissions_batch([
+            (test_id, first, "ABCDE", "ABCDE", 5, 0, 100.0, NOW, 10),
+            (test_id, second, "ABCDD", "ABCDD", 4, 1, 80.0, NOW, 10),
+        ])
+        self.assertEqual(q.upsert_user(1, "a", "Ali"), first)
+        self.assertEqual(q.get_registered_user(1)['id'], first)
+
+
+
+class TestRegradeSubmissions(TempDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_id = self.make_test("AAAAA")
+        self.answers = ["AAAAA", "BBBBB", "AABBC"]
+        q.insert_submissions_batch([
+            (self.test_id, q.upsert_user(i, None, f"U{i}"), a, a, 0, 5, 0.0, NOW, 10)
+            for i, a in enumerate(self.answers, 1)
+        ])
+
+    def scores(self):
+        rows = q.get_test_submissions(self.test_id)
+        return {r['normalized_answers']: (r['correct_count'], r['percent']) for r in rows}
+
+    def test_uses_current_key(self):
+        # A regrade started for an earlier correction still scores against the latest key
+        q.update_test_answer_key(self.test_id, "AAAAB")
+        q.update_test_answer_key(self.test_id, "BBBBB")
+        count, last_id = q.regrade_submissions(self.test_id, chunk_size=2)
+        self.assertEqual(count, 3)
+        self.assertEqual(self.scores(), {"AAAAA": (0, 0.0), "BBBBB": (5, 100.0), "AABBC": (2, 40.0)})
+        self.assertEqual(q.regrade_submissions(self.test_id, after_id=last_id), (0, last_id))
+
+    def test_plan(self):
+        q.update_test_answer_key(self.test_id, "AAAAA", "A/B A A A A")
+        q.regrade_submissions(self.test_id)
+        self.assertEqual(self.scores()["BBBBB"], (1, 20.0))
+
+
+class TestInsertSubmission(TempDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_id = self.make_test("AAAAA")
+        self.users = [q.upsert_user(i, None, f"U{i}") for i in range(1, 5)]
+
+    def params(self, user_id, answers="AAAAA", correct=5, percent=100.0):
+        return (self.test_id, user_id, answers, answers, correct, 5 - correct, percent, NOW, 10)
+
+    def test_inserted_row_returned(self):
+        inserted, row = q.insert_submission(*self.params(self.users[0], "AAABB", 3, 60.0))
+        self.assertTrue(inserted)
+        stored = q.get_submission(self.test_id, self.users[0])
+        self.assertEqual(row['id'], stored['id'])
+        self.assertEqual((row['correct_count'], row['wrong_count'], row['percent']), (3, 2, 60.0))
+
+    def test_duplicate_returns_stored_row(self):
+        _, first = q.insert_submission(*self.params(self.users[0], "AAABB", 3, 60.0))
+        inserted, row = q.insert_submission(*self.params(self.users[0], "AAAAA", 5, 100.0))
+        self.assertFalse(inserted)
+        self.assertEqual(row['id'], first['id'])
+        self.assertEqual(row['percent'], 60.0)
+        self.assertEqual(q.get_submission_count(self.test_id), 1)
+
+    def test_batch_with_duplicates(self):
+        _, existing = q.insert_submission(*self.params(self.users[0], "BBBBB", 0, 0.0))
+        results = q.insert_submissions_batch([
+            self.params(self.users[1], "AAABB", 3, 60.0),
+            self.params(self.users[0], "AAAAA", 5, 100.0),  # already stored
+            self.params(self.users[2]),
+            self.params(self.users[1], "AAAAA", 5, 100.0),  # second in this batch
+        ])
+        self.assertEqual([inserted for inserted, _ in results], [True, False, True, False])
+        self.assertEqual(results[1][1]['id'], existing['id'])
+        self.assertEqual(results[1][1]['percent'], 0.0)
+        self.assertEqual(results[3][1]['id'], results[0][1]['id'])
+        self.assertEqual(results[3][1]['percent'], 60.0)
+        self.assertEqual(q.get_submission_count(self.test_id), 3)
+        self.assertEqual(q.get_submission(self.test_id, self.users[1])['percent'], 60.0)
+
+
+class TestTestMetaCache(TempDatabaseTestCase):
+    def test_write_during_load_not_cached(self):
+        test_id = self.make_test()
+        q.start_test_db(test_id, NOW, NOW + timedelta(hours=1))
+        get_test = q.get_test
+
+        def read_then_end(test_id):
+            row = get_test(test_id)
+            # The admin ends the test after the row was read but before it is cached
+            q.end_test_db(test_id)
+            return row
+
+        with mock.patch.object(q, "get_test", read_then_end):
+            self.assertEqual(q.load_test_meta(test_id).status, 'active')
+        self.assertIs(test_cache.get(test_id), MISSING)
+        self.assertEqual(q.get_test_meta(test_id).status, 'ended')
+
+    def test_cached_until_invalidated(self):
+        test_id = self.make_test()
+        meta = q.get_test_meta(test_id)
+        self.assertIs(q.get_test_meta(test_id), meta)
+        q.update_test_answer_key(test_id, "BBBBB")
+        self.assertEqual(q.get_test_meta(test_id).answer_key, "BBBBB")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from services.ranking import RankIndex, _rank_key
+
+def _row(submission_id, percent, correct, time_taken, name=None):
+    return (_rank_key(percent, correct, time_taken), submission_id,
+            name or f"User {submission_id}", percent, correct)
+
+class TestRankIndex(unittest.TestCase):
+    def test_rank_of_order(self):
+        index = RankIndex()
+        index.add(1, 80.0, 8, 300, "A")
+        index.add(2, 90.0, 9, 500, "B")
+        index.add(3, 80.0, 8, 200, "C")  # same score as A, but faster
+        self.assertEqual(index.rank_of(90.0, 9, 500), 1)
+        self.assertEqual(index.rank_of(80.0, 8, 200), 2)
+        self.assertEqual(index.rank_of(80.0, 8, 300), 3)
+        # A result worse than everyone ranks last
+        self.assertEqual(index.rank_of(10.0, 1, 100), 4)
+
+    def test_rank_of_ties(self):
+        index = RankIndex()
+        index.add(1, 100.0, 10, 60, "A")
+        index.add(2, 50.0, 5, 60, "B")
+        index.add(3, 50.0, 5, 60, "C")
+        index.add(4, 20.0, 2, 60, "D")
+        # Ties share a rank: 1, 2, 2, 4
+        self.assertEqual(index.rank_of(50.0, 5, 60), 2)
+        self.assertEqual(index.rank_of(20.0, 2, 60), 4)
+        self.assertEqual([r[0] for r in index.top(4)], [1, 2, 2, 4])
+
+    def test_add_then_rank(self):
+        index = RankIndex()
+        for i in range(50):
+            index.add(i, float(i), i, 100, f"User {i}")
+        self.assertEqual(len(index), 50)
+        self.assertEqual(index.rank_of(49.0, 49, 100), 1)
+        index.add(100, 60.0, 60, 100, "Best")
+        self.assertEqual(index.rank_of(60.0, 60, 100), 1)
+        self.assertEqual(index.rank_of(49.0, 49, 100), 2)
+        self.assertEqual(index.top(2), [(1, "Best", 60.0, 60), (2, "User 49", 49.0, 49)])
+
+    def test_add_ignores_duplicates(self):
+        index = RankIndex()
+        index.add(1, 70.0, 7, 100, "A")
+        index.add(1, 70.0, 7, 100, "A")
+        self.assertEqual(len(index), 1)
+
+    def test_merge_loaded_dedupes_live_rows(self):
+        index = RankIndex()
+        # Recorded while the load was running; 11 also made it into the rows
+        index.add(11, 95.0, 19, 120, "Live and loaded")
+        index.add(12, 40.0, 8, 120, "Live only")
+        rows = [
+            _row(11, 95.0, 19, 120, "Live and loaded"),
+            _row(10, 90.0, 18, 100),
+            _row(9, 50.0, 10, 300),
+        ]
+        index.merge_loaded(rows)
+        self.assertTrue(index.loaded)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.rank_of(95.0, 19, 120), 1)
+        self.assertEqual(index.rank_of(40.0, 8, 120), 4)
+        self.assertEqual([r[1] for r in index.top(10)],
+                         ["Live and loaded", "User 10", "User 9", "Live only"])
+
+if __name__ == '__main__':
+    unittest.main()
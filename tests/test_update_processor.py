@@ -0,0 +1,77 @@
+import asyncio
+import unittest
+from telegram import Update
+from services.update_processor import ChatOrderedUpdateProcessor
+
+def make_update(update_id, chat_id):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': "x",
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': "U"},
+        },
+    }, None)
+
+class TestChatOrderedUpdateProcessor(unittest.IsolatedAsyncioTestCase):
+    async def test_same_chat_in_order(self):
+        processor = ChatOrderedUpdateProcessor(8)
+        handled = {}
+
+        async def handle(chat_id, i):
+            await asyncio.sleep(0.001 * ((i * 7) % 3))
+            handled.setdefault(chat_id, []).append(i)
+
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(n, chat_id), handle(chat_id, i)))
+            for n, (i, chat_id) in enumerate((i, c) for i in range(10) for c in (1, 2, 3))
+        ]
+        await asyncio.gather(*tasks)
+        self.assertEqual(handled, {chat_id: list(range(10)) for chat_id in (1, 2, 3)})
+        self.assertEqual(processor.stats()['active_chats'], 0)
+
+    async def test_backlog_does_not_block_other_chats(self):
+        processor = ChatOrderedUpdateProcessor(2)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        finished = {}
+
+        async def handle(name, seconds):
+            await asyncio.sleep(seconds)
+            finished[name] = loop.time() - started
+
+        # One chat with more queued updates than there are slots
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(i, 1), handle(f"busy{i}", 0.05)))
+            for i in range(6)
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(processor.stats()['queued'], 5)
+        tasks.append(asyncio.create_task(processor.process_update(make_update(100, 2), handle("other", 0.001))))
+        await asyncio.gather(*tasks)
+        # The other chat had a free slot, so it didn't wait for the backlog
+        self.assertLess(finished["other"], 0.04)
+        self.assertGreaterEqual(finished["busy5"], 0.3)
+
+    async def test_limit(self):
+        processor = ChatOrderedUpdateProcessor(3)
+        running = [0, 0]
+
+        async def handle():
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(i, i), handle())) for i in range(10)
+        ]
+        await asyncio.sleep(0)
+        # Updates waiting for a slot count as queued too
+        self.assertEqual(processor.stats()['queued'], 7)
+        await asyncio.gather(*tasks)
+        self.assertEqual(running[1], 3)
+        self.assertEqual(processor.stats()['processed'], 10)
+
+if __name__ == '__main__':
+    unittest.main()
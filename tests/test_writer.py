@@ -0,0 +1,103 @@
+import asyncio
+import unittest
+from datetime import datetime
+from unittest import mock
+import db.queries as q
+from db import writer
+from db.cache import get_key_version
+from db.writer import SubmissionWriter
+from dbtest import TempDatabaseTestCase
+
+NOW = datetime(2026, 1, 1, 9, 0)
+
+class TestSubmissionWriter(TempDatabaseTestCase, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_id = self.make_test("AAAAA")
+        self.users = [q.upsert_user(i, None, f"U{i}") for i in range(1, 11)]
+        self.batches = []
+        batch_insert = writer.db.insert_submissions_batch
+
+        async def record(rows):
+            self.batches.append(len(rows))
+            return await batch_insert(rows)
+        patcher = mock.patch.object(writer.db, "insert_submissions_batch", record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def start(self, **kwargs):
+        w = SubmissionWriter(**kwargs)
+        await w.start()
+        self.addAsyncCleanup(w.stop)
+        return w
+
+    def submit(self, w, user_id, answers="AAAAA", correct=5, percent=100.0, key_version=None):
+        return w.submit(self.test_id, user_id, answers, answers, correct, 5 - correct, percent, NOW, 10,
+                        key_version=key_version)
+
+    async def test_batches_by_size(self):
+        w = await self.start(max_batch=3, max_delay=0.05)
+        results = await asyncio.gather(*[self.submit(w, u) for u in self.users[:7]])
+        self.assertEqual(self.batches, [3, 3, 1])
+        self.assertTrue(all(inserted for inserted, _ in results))
+        self.assertEqual(len({row['id'] for _, row in results}), 7)
+        self.assertEqual(q.get_submission_count(self.test_id), 7)
+
+    async def test_batches_by_delay(self):
+        w = await self.start(max_batch=100, max_delay=0.05)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(self.submit(w, self.users[0]), self.submit(w, self.users[1]))
+        self.assertGreaterEqual(loop.time() - started, 0.05)
+        self.assertEqual(self.batches, [2])
+
+    async def test_resolves_with_row(self):
+        w = await self.start(max_batch=10, max_delay=0.001)
+        inserted, row = await self.submit(w, self.users[0], "AAABB", 3, 60.0)
+        self.assertTrue(inserted)
+        self.assertEqual((row['correct_count'], row['wrong_count'], row['percent']), (3, 2, 60.0))
+        self.assertEqual(q.get_submission(self.test_id, self.users[0])['id'], row['id'])
+
+    async def test_duplicates_first_wins(self):
+        w = await self.start(max_batch=10, max_delay=0.05)
+        await self.submit(w, self.users[0], "AAAAA", 5, 100.0)
+        first, second, other = await asyncio.gather(
+            self.submit(w, self.users[1], "AAABB", 3, 60.0),
+            self.submit(w, self.users[1], "AAAAA", 5, 100.0),
+            self.submit(w, self.users[0], "BBBBB", 0, 0.0),
+        )
+        self.assertTrue(first[0])
+        self.assertEqual(second, (False, first[1]))
+        self.assertFalse(other[0])
+        self.assertEqual(other[1]['percent'], 100.0)
+        self.assertEqual(q.get_submission(self.test_id, self.users[1])['percent'], 60.0)
+
+    async def test_regrades_stale_key(self):
+        w = await self.start(max_batch=10, max_delay=0.001)
+        version = get_key_version(self.test_id)
+        q.update_test_answer_key(self.test_id, "BBBBB")
+        # Graded against AAAAA before the key changed
+        inserted, row = await self.submit(w, self.users[0], "BBBBB", 0, 0.0, key_version=version)
+        self.assertTrue(inserted)
+        self.assertEqual((row['correct_count'], row['percent']), (5, 100.0))
+        self.assertEqual(q.get_submission(self.test_id, self.users[0])['percent'], 100.0)
+
+        current = get_key_version(self.test_id)
+        inserted, row = await self.submit(w, self.users[1], "AAAAA", 0, 0.0, key_version=current)
+        self.assertEqual(row['percent'], 0.0)
+
+    async def test_bad_row_fails_alone(self):
+        w = await self.start(max_batch=10, max_delay=0.05)
+        good, bad, also_good = await asyncio.gather(
+            self.submit(w, self.users[0]),
+            self.submit(w, None),  # NOT NULL user_id
+            self.submit(w, self.users[1]),
+            return_exceptions=True,
+        )
+        self.assertTrue(good[0])
+        self.assertTrue(also_good[0])
+        self.assertIsInstance(bad, Exception)
+        self.assertEqual(q.get_submission_count(self.test_id), 2)
+
+if __name__ == '__main__':
+    unittest.main()